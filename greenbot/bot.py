@@ -8,20 +8,25 @@ import time
 
 from greenbot.apiwrappers.movienight_api import MovieNightAPI
 from greenbot.models.action import ActionParser
-from greenbot.models.user import User
+from greenbot.models.action import RenderBudget
 from greenbot.models.message import Message
 from greenbot.models.module import ModuleManager
 from greenbot.models.banphrase import BanphraseManager
+from greenbot.managers.sock import SocketClientManager
 from greenbot.managers.sock import SocketManager
 from greenbot.managers.schedule import ScheduleManager
 from greenbot.managers.db import DBManager
 from greenbot.managers.redis import RedisManager
 from greenbot.managers.message import MessageManager
 from greenbot.managers.handler import HandlerManager
+from greenbot.managers.cooldown import CooldownManager
+from greenbot.managers.latency import LatencyManager
+from greenbot.managers.points import PointsManager
 from greenbot.managers.discord_bot import DiscordBotManager
 from greenbot.managers.command import CommandManager
 from greenbot.managers.twitter import TwitterManager
 from greenbot.managers.timeout import TimeoutManager
+from greenbot.managers.user import UserManager
 from greenbot.migration.db import DatabaseMigratable
 from greenbot.migration.migrate import Migration
 from greenbot.functions import Functions
@@ -87,6 +92,13 @@ class Bot:
             "parse_command_from_message", self.parse_command_from_message
         )
         self.bot_name = self.config["main"]["bot_name"]
+        LatencyManager.init(self.bot_name)
+        ScheduleManager.execute_every(
+            LatencyManager.PUBLISH_INTERVAL, LatencyManager.publish
+        )
+        ScheduleManager.execute_every(
+            LatencyManager.PUBLISH_INTERVAL, RenderBudget.publish, args=[self.bot_name]
+        )
         self.command_prefix = self.config["discord"]["command_prefix"]
         self.settings = {
             "discord_token": self.discord_token,
@@ -95,7 +107,15 @@ class Bot:
             "discord_guild_id": self.config["discord"]["discord_guild_id"],
         }
 
+        self.roles = {}
+        self.role_levels = {}
+        self.member_role_levels = {}
         HandlerManager.add_handler("discord_ready", self.wait_discord_load)
+        HandlerManager.add_handler("discord_member_update", self.on_member_update)
+        HandlerManager.add_handler("discord_member_remove", self.on_member_remove)
+        HandlerManager.add_handler("discord_guild_role_create", self.on_role_change)
+        HandlerManager.add_handler("discord_guild_role_delete", self.on_role_change)
+        HandlerManager.add_handler("discord_guild_role_update", self.on_role_change)
 
         self.discord_bot = DiscordBotManager(
             bot=self,
@@ -107,16 +127,35 @@ class Bot:
         self.filters = Filters(self, self.discord_bot)
         self.functions = Functions(self, self.filters)
 
-    def psudo_level_member(self, db_session, member):
-        user_level = 100
-        user = User._create_or_get_by_discord_id(db_session, str(member.id), str(member))
-        for role_id in self.roles:
+    async def psudo_level_member(self, db_session, member):
+        user = await self.user_manager.fetch(member.id, str(member))
+        role_level = self.member_role_levels.get(member.id, None)
+        if role_level is None:
+            role_level = 100
+            for role in member.roles:
+                role_level = max(role_level, self.role_levels.get(role.id, 0))
+            self.member_role_levels[member.id] = role_level
+        return max(role_level, user.level)
+
+    def refresh_role_levels(self):
+        """ Rebuilds the role id -> level map from self.roles, has to be called whenever self.roles changes """
+        self.role_levels = {}
+        for role_id, level in self.roles.items():
             role = self.filters.get_role([role_id], None, {})[0]
             if not role:
                 continue
-            if role in member.roles:
-                user_level = max(int(user_level), int(self.roles[role_id]))
-        return max(user_level, user.level)
+            self.role_levels[role.id] = int(level)
+        self.member_role_levels = {}
+
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.member_role_levels.pop(after.id, None)
+
+    async def on_member_remove(self, member):
+        self.member_role_levels.pop(member.id, None)
+
+    async def on_role_change(self, **_kwargs):
+        self.refresh_role_levels()
 
     @property
     def bot_id(self):
@@ -124,7 +163,13 @@ class Bot:
 
     async def wait_discord_load(self):
         self.roles = {}
+        self.role_levels = {}
+        self.member_role_levels = {}
         self.socket_manager = SocketManager(self.bot_name, self.execute_now)
+        SocketClientManager.init(self.bot_name)
+        self.user_manager = UserManager(self)
+        self.cooldown_manager = CooldownManager(self)
+        self.points_manager = PointsManager(self)
         self.message_manager = MessageManager(self)
         self.timeout_manager = TimeoutManager(self)
         self.banphrase_manager = BanphraseManager(self)
@@ -144,15 +189,7 @@ class Bot:
                 "No admin user specified. See the [main] section in the example config for its usage."
             )
         else:
-            with DBManager.create_session_scope() as db_session:
-                owner = User._create_or_get_by_discord_id(db_session, str(owner))
-                if owner is None:
-                    log.warning(
-                        "The login name you entered for the admin user does not exist on twitch. "
-                        "No admin user has been created."
-                    )
-                else:
-                    owner.level = 2000
+            await self.user_manager.set(owner, level=2000)
 
     def execute_now(self, function, *args, **kwargs):
         self.execute_delayed(0, function, *args, **kwargs)
@@ -165,6 +202,10 @@ class Bot:
 
     def quit_bot(self):
         try:
+            self.message_manager.flush_now()
+            self.banphrase_manager.flush_hits_now()
+            self.points_manager.flush_now()
+            self.commands.flush_uses_now()
             self.module_manager.disable_all()
             self.socket_manager.quit()
         except:
@@ -209,43 +250,39 @@ class Bot:
         return await self.discord_bot.say(channel, message, embed, file, ignore_escape)
 
     async def parse_command_from_message(
-        self, message, content, user_level, author, not_whisper, channel
+        self,
+        message,
+        content,
+        user_level,
+        author,
+        not_whisper,
+        channel,
     ):
-        msg_lower = content.lower()
-        if msg_lower[:1] == self.settings["command_prefix"]:
-            msg_lower_parts = msg_lower.split(" ")
-            trigger = msg_lower_parts[0][1:]
-            msg_raw_parts = content.split(" ")
-            if trigger not in self.commands:
-                if len(msg_lower_parts) < 1:
-                    return
-                trigger += " " + msg_lower_parts[1] if len(msg_lower_parts) > 1 else ""
-                if trigger not in self.commands:
-                    return
-                msg_raw_parts = (
-                    msg_raw_parts[1:] if len(msg_raw_parts) > 1 else []
-                )
-            remaining_message = (
-                " ".join(msg_raw_parts[1:]) if len(msg_raw_parts) > 1 else ""
+        resolved = self.commands.resolve(content, self.settings["command_prefix"])
+        if resolved is None:
+            return
+
+        command, trigger, remaining_message, sub_command = resolved
+        extra_args = {
+            "trigger": trigger,
+            "message_raw": message,
+            "user_level": user_level,
+            "whisper": not not_whisper,
+        }
+        if sub_command is not None:
+            extra_args["sub_command"] = sub_command
+
+        try:
+            await command.run(
+                bot=self,
+                author=author,
+                channel=channel if not_whisper else None,
+                message=remaining_message,
+                args=extra_args,
             )
-            command = self.commands[trigger]
-            extra_args = {
-                "trigger": trigger,
-                "message_raw": message,
-                "user_level": user_level,
-                "whisper": not not_whisper,
-            }
-            try:
-                await command.run(
-                    bot=self,
-                    author=author,
-                    channel=channel if not_whisper else None,
-                    message=remaining_message,
-                    args=extra_args,
-                )
-            except Exception as e:
-                log.error(f"Error thrown on command {trigger}")
-                log.exception(e)
+        except Exception as e:
+            log.error(f"Error thrown on command {trigger}")
+            log.exception(e)
 
     async def add_role(self, user, role, reason=None):
         return await self.discord_bot.add_role(user, role)
@@ -257,6 +294,37 @@ class Bot:
         await self.private_message(user=author, message="Quitting the bot!")
         self.quit_bot()
 
+    async def latency(self, bot, author, channel, message, args):
+        if message and message.strip().lower() == "reset":
+            LatencyManager.init(self.bot_name)
+            RenderBudget.exceeded.clear()
+            await self.private_message(user=author, message="Latency histograms have been reset")
+            return True
+
+        summary = LatencyManager.summary()
+        if not summary:
+            response = "No latency data has been collected yet"
+        else:
+            lines = [
+                f"{stage}: {data['count']} samples, p50 {data['p50']:.2f} ms, p95 {data['p95']:.2f} ms, p99 {data['p99']:.2f} ms, max {data['max']:.2f} ms"
+                for stage, data in sorted(summary.items())
+            ]
+            response = "```\n" + "\n".join(lines) + "\n```"
+
+        budget = RenderBudget.summary()
+        if budget:
+            lines = [
+                f"{command}: " + ", ".join(f"{limit} {count}" for limit, count in sorted(limits.items()))
+                for command, limits in sorted(budget.items(), key=lambda item: str(item[0]))
+            ]
+            response += "\nRender budget exceeded:\n```\n" + "\n".join(lines) + "\n```"
+
+        if args["whisper"]:
+            await self.private_message(user=author, message=response, ignore_escape=True)
+        else:
+            await self.say(channel, response, ignore_escape=True)
+        return True
+
     def apply_filter(self, resp, f):
         available_filters = {
             "strftime": _filter_strftime,
@@ -16,3 +16,11 @@ class InvalidPointAmount(Exception):
 
 class TimeoutException(Exception):
     pass
+
+
+class TemplateBudgetExceeded(Exception):
+    def __init__(self, limit, message):
+        super().__init__(message)
+        self.limit = limit
+        # How many template functions had already been run
+        self.functions_ran = 0
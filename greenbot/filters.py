@@ -1,20 +1,47 @@
 import logging
 
-from greenbot.managers.db import DBManager
-from greenbot.models.user import User
-
 import discord
 import datetime
 import regex as re
 
+from greenbot.managers.db import DBManager
+from greenbot.models.action import MappingMethods
+from greenbot.models.user import User
+
 log = logging.getLogger("greenbot")
 
 
 class Filters:
+    # Filter name used in templates -> method
+    FILTERS = {
+        "role": "get_role",
+        "_role": "get_role_value",
+        "member": "get_member",
+        "currency": "get_currency",
+        "user": "get_user",
+        "userinfo": "get_user_info",
+        "roleinfo": "get_role_info",
+        "commands": "get_commands",
+        "commandinfo": "get_command_info",
+        "time": "get_time_value",
+        "command": "get_command_value",
+        "author": "get_author_value",
+        "_channel": "get_channel_value",
+        "channel": "get_channel",
+        "emoji": "get_emoji_url",
+    }
+    # These return an object, templates look the key up on it
+    ATTRIBUTE_FILTERS = {"role", "member", "user", "command", "author", "_channel"}
+
     def __init__(self, bot, discord_bot):
         self.bot = bot
         self.discord_bot = discord_bot
 
+        for name, method_name in self.FILTERS.items():
+            MappingMethods.register_filter(
+                name, getattr(self, method_name), name in self.ATTRIBUTE_FILTERS
+            )
+
     def get_role(self, args, key, extra):
         role = self.discord_bot.get_role(args[0]) or self.discord_bot.get_role_by_name(
             args[0]
@@ -35,11 +62,13 @@ class Filters:
     def get_currency(self, args, key, extra):
         return self.bot.get_currency().get(key) if key else None, None
 
-    def get_user(self, args, key, extra):
+    async def get_user(self, args, key, extra):
         member = self.get_member([args[0]], None, extra)[0]
-        with DBManager.create_session_scope() as db_session:
-            db_user = User._create_or_get_by_discord_id(db_session, member.id, str(member))
-            return getattr(db_user, key) if key and db_user else db_user, None
+        user = await self.bot.user_manager.fetch(member.id, str(member))
+        if key and not hasattr(user, key):
+            # Only some of the columns are cached, the rest are read from the full row
+            return await DBManager.run(User._get_attribute, member.id, key), None
+        return getattr(user, key) if key and user else user, None
 
     def get_user_info(self, args, key, extra):
         try:
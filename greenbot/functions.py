@@ -2,17 +2,35 @@ import logging
 import discord
 
 from greenbot.managers.db import DBManager
-from greenbot.models.user import User
+from greenbot.models.action import MappingMethods
 from greenbot import utils
 
 log = logging.getLogger("greenbot")
 
 
 class Functions:
+    # Function name used in templates -> method
+    FUNCTIONS = {
+        "kick": "func_kick_member",
+        "ban": "func_ban_member",
+        "unban": "func_unban_member",
+        "addrole": "func_add_role_member",
+        "removerole": "func_remove_role_member",
+        "level": "func_level",
+        "setpoints": "func_set_balance",
+        "adjpoints": "func_adj_balance",
+        "output": "func_output",
+        "embed": "func_embed_image",
+        "rename": "func_rename",
+    }
+
     def __init__(self, bot, filters):
         self.bot = bot
         self.filters = filters
 
+        for name, method_name in self.FUNCTIONS.items():
+            MappingMethods.register_function(name, getattr(self, method_name))
+
     async def func_kick_member(
         self, args, extra={}
     ):  # !kick <member_mention> <reason....>
@@ -25,7 +43,7 @@ class Functions:
             return "Member not found", None
 
         with DBManager.create_session_scope() as db_session:
-            if extra["user_level"] < self.bot.psudo_level_member(db_session, member):
+            if extra["user_level"] < await self.bot.psudo_level_member(db_session, member):
                 return (
                     "You cannot kick someone who has the same or a higher level than you :)",
                     None,
@@ -50,7 +68,7 @@ class Functions:
             if author.id == member.id:
                 return "You cannot ban yourself :)", None
 
-            if extra["user_level"] < self.bot.psudo_level_member(db_session, member):
+            if extra["user_level"] < await self.bot.psudo_level_member(db_session, member):
                 return (
                     "You cannot ban someone who has the same or a higher level than you :)",
                     None,
@@ -166,14 +184,13 @@ class Functions:
         if level >= extra["user_level"]:
             return "You cannot set a level higher then your own!", None
 
-        with DBManager.create_session_scope() as db_session:
-            user = User._create_or_get_by_discord_id(db_session, str(member.id), str(member))
-            if user.level >= extra["user_level"]:
-                return (
-                    "You cannot set a level of a user with a higher then your own!",
-                    None,
-                )
-            user.level = level
+        user = await self.bot.user_manager.fetch(member.id, str(member))
+        if user.level >= extra["user_level"]:
+            return (
+                "You cannot set a level of a user with a higher then your own!",
+                None,
+            )
+        await self.bot.user_manager.set(member.id, level=level)
         return f"Level, {level}, set for {member.mention}!", None
 
     async def func_set_balance(self, args, extra={}):
@@ -192,9 +209,8 @@ class Functions:
                 None,
             )
 
-        with DBManager.create_session_scope() as db_session:
-            user = User._create_or_get_by_discord_id(db_session, str(member.id), str(member))
-            user.points = amount
+        await self.bot.user_manager.fetch(member.id, str(member))
+        await self.bot.points_manager.set_balance(member.id, amount, "set_balance")
         currency = self.bot.get_currency().get("name").capitalize()
         return f"{currency} balance for {member.mention} set to {amount}", None
 
@@ -214,9 +230,9 @@ class Functions:
                 None,
             )
 
-        with DBManager.create_session_scope() as db_session:
-            user = User._create_or_get_by_discord_id(db_session, str(member.id), str(member))
-            user.points += amount
+        # Makes sure the user row exists before it's updated
+        await self.bot.user_manager.fetch(member.id, str(member))
+        await self.bot.points_manager.adjust(member.id, amount, "adj_balance")
         action = "added to" if amount > 0 else "removed from"
         currency = self.bot.get_currency().get("name")
         return f"{amount} {currency} {action} {member.mention} ", None
@@ -241,7 +257,7 @@ class Functions:
             return None, None
 
         with DBManager.create_session_scope() as db_session:
-            user_level = self.bot.psudo_level_member(db_session, member)
+            user_level = await self.bot.psudo_level_member(db_session, member)
             if user_level > extra["user_level"]:
                 return None, None
             
@@ -38,6 +38,9 @@ class AdminLogManager:
         "Banphrase edited": LogEntryTemplate('Edited banphrase #{} from "{}"'),
         "Banphrase removed": LogEntryTemplate('Removed banphrase #{} "{}"'),
         "Banphrase toggled": LogEntryTemplate('{} banphrase #{} "{}"'),
+        "Banphrase quarantined": LogEntryTemplate(
+            'Disabled banphrase #{} "{}", the regex was too slow'
+        ),
         "Blacklist link added": LogEntryTemplate('Added blacklist link "{}"'),
         "Blacklist link removed": LogEntryTemplate('Removed blacklisted link "{}"'),
         "Module edited": LogEntryTemplate('Edited module "{}"'),
@@ -1,18 +1,147 @@
 import argparse
 import logging
+import time
 from collections import UserDict
 
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from greenbot.managers.db import DBManager
+from greenbot.managers.schedule import ScheduleManager
 from greenbot.models.command import Command
 from greenbot.models.command import CommandData
 from greenbot.utils import find
+from greenbot.utils import now
 from greenbot.models.command import parse_command_for_web
 
 log = logging.getLogger(__name__)
 
 
+class CommandTrieNode:
+    def __init__(self):
+        self.children = {}
+        self.command = None
+        self.trigger = None
+        # The sub-commands of a multi action command, by alias
+        self.sub_commands = None
+
+
+class CommandResolver:
+    """ Token trie over the aliases of all commands, groups are just an extra token in front of the alias """
+
+    def __init__(self, commands):
+        self.root = CommandTrieNode()
+        for alias, command in commands.items():
+            self.add(alias, command)
+
+    def add(self, alias, command):
+        node = self.root
+        for token in alias.split(" "):
+            node = node.children.setdefault(token, CommandTrieNode())
+        node.command = command
+        node.trigger = alias
+        if command.action and command.action.type == "multi":
+            node.sub_commands = command.action.commands
+        else:
+            node.sub_commands = None
+
+    def remove(self, alias):
+        tokens = alias.split(" ")
+        path = [self.root]
+        for token in tokens:
+            node = path[-1].children.get(token, None)
+            if node is None:
+                return
+            path.append(node)
+
+        node = path[-1]
+        node.command = None
+        node.trigger = None
+        node.sub_commands = None
+
+        # Prune the branch back up to the last node that is still in use
+        for token, parent, child in zip(
+            reversed(tokens), reversed(path[:-1]), reversed(path[1:])
+        ):
+            if child.children or child.command is not None:
+                break
+            del parent.children[token]
+
+    def resolve(self, content, prefix):
+        """
+        Finds the command the message triggers in a single scan over the message.
+        Returns None, or (command, trigger, remaining message, sub_command).
+        For multi action commands with a remaining message, sub_command is
+        (alias, sub-command or None, remaining message after the alias)
+        """
+        if content[:1] != prefix:
+            return None
+
+        node = self.root
+        start = 1
+        while True:
+            end = content.find(" ", start)
+            if end == -1:
+                end = len(content)
+            node = node.children.get(content[start:end].lower(), None)
+            if node is None:
+                return None
+
+            # The shortest alias wins, like it always has
+            if node.command is not None:
+                break
+
+            if end == len(content):
+                return None
+            start = end + 1
+
+        remaining_message = content[end + 1 :]
+        sub_command = None
+        if node.sub_commands is not None and remaining_message:
+            alias, _, sub_message = remaining_message.partition(" ")
+            alias = alias.lower()
+            sub_command = (alias, node.sub_commands.get(alias, None), sub_message)
+
+        return node.command, node.trigger, remaining_message, sub_command
+
+
+def merge_command(alias, command, out):
+    if alias in out:
+        if (
+            command.action
+            and command.action.type == "multi"
+            and out[alias].action
+            and out[alias].action.type == "multi"
+        ):
+            out[alias].action += command.action
+        else:
+            out[alias] = command
+    else:
+        out[alias] = command
+
+
+def assign_cooldown_keys(prefix, commands):
+    """
+    Names the commands without a database id after where they come from, so their
+    cooldowns keep the same keys across restarts and processes
+    """
+    for alias, command in commands.items():
+        if command.id is not None or command.cooldown_key is not None:
+            continue
+
+        command.cooldown_key = f"{prefix}:{alias}"
+        if is_multi(command):
+            assign_cooldown_keys(command.cooldown_key, command.action.original_commands)
+
+
+def is_multi(command):
+    return (
+        command is not None
+        and command.action is not None
+        and command.action.type == "multi"
+    )
+
+
 class CommandManager(UserDict):
     """ This class is responsible for compiling commands from multiple sources
     into one easily accessible source.
@@ -22,14 +151,21 @@ class CommandManager(UserDict):
      - module_commands = Commands that are loaded from enabled modules
     """
 
+    # How often (in seconds) the usage counters are written to the database
+    FLUSH_USES_INTERVAL = 30
+
     def __init__(self, socket_manager=None, module_manager=None, bot=None):
         UserDict.__init__(self)
         self.db_session = DBManager.create_session()
+        self.pending_uses = {}
+        # The aliases of each enabled module as of the last update, by module ID
+        self.module_aliases = {}
 
         self.internal_commands = {}
         self.db_commands = {}
         self.module_commands = {}
         self.data = {}
+        self.resolver = CommandResolver({})
 
         self.bot = bot
         self.module_manager = module_manager
@@ -39,10 +175,15 @@ class CommandManager(UserDict):
             socket_manager.add_handler("command.update", self.on_command_update)
             socket_manager.add_handler("command.remove", self.on_command_remove)
 
-    async def on_module_reload(self, _data):
-        log.debug("Rebuilding commands...")
-        self.rebuild()
-        log.debug("Done rebuilding commands")
+        if self.bot:
+            self.flush_uses_job = ScheduleManager.execute_every(
+                self.FLUSH_USES_INTERVAL, self.flush_uses
+            )
+
+    async def on_module_reload(self, data):
+        log.debug("Updating module commands...")
+        self.update_module(data.get("id", None))
+        log.debug("Done updating module commands")
 
     async def on_command_update(self, data):
         try:
@@ -51,17 +192,21 @@ class CommandManager(UserDict):
             log.warning("No command ID found in on_command_update")
             return
 
+        aliases = set()
         command = find(
             lambda command: command.id == command_id, self.db_commands.values()
         )
         if command is not None:
+            aliases.update(command.aliases)
             self.remove_command_aliases(command)
 
-        self.load_by_id(command_id)
+        command = self.load_by_id(command_id)
+        if command is not None:
+            aliases.update(command.aliases)
 
         log.debug(f"Reloaded command with id {command_id}")
 
-        self.rebuild()
+        self.update_aliases(aliases)
 
     async def on_command_remove(self, data):
         try:
@@ -82,7 +227,7 @@ class CommandManager(UserDict):
 
         log.debug(f"Remove command with id {command_id}")
 
-        self.rebuild()
+        self.update_aliases(command.aliases)
 
     def __del__(self):
         self.db_session.close()
@@ -90,6 +235,63 @@ class CommandManager(UserDict):
     def commit(self):
         self.db_session.commit()
 
+    def record_use(self, command):
+        """ Counts a use of the command, the counters are written to the database on the next flush """
+        count, _ = self.pending_uses.get(command.id, (0, None))
+        self.pending_uses[command.id] = (count + 1, now())
+
+    def take_uses(self):
+        pending_uses = self.pending_uses
+        self.pending_uses = {}
+        return pending_uses
+
+    def requeue_uses(self, pending_uses):
+        log.exception(f"Failed to write the uses of {len(pending_uses)} commands, requeueing them")
+        for command_id, (count, last_used) in self.pending_uses.items():
+            pending_count, _ = pending_uses.get(command_id, (0, None))
+            pending_uses[command_id] = (pending_count + count, last_used)
+        self.pending_uses = pending_uses
+
+    def apply_uses(self, uses):
+        """ Mirrors the flushed counters on the loaded CommandData without marking them dirty """
+        commands = {command.id: command for command in self.db_commands.values()}
+        for command_id, (count, last_used) in uses.items():
+            command = commands.get(command_id, None)
+            if command is None or command.data is None:
+                continue
+
+            set_committed_value(command.data, "num_uses", command.data.num_uses + count)
+            set_committed_value(command.data, "_last_date_used", last_used)
+
+    async def flush_uses(self):
+        if not self.pending_uses:
+            return
+
+        pending_uses = self.take_uses()
+        try:
+            await DBManager.run(CommandData._add_uses, pending_uses)
+        except:
+            self.requeue_uses(pending_uses)
+            return
+
+        # The counters are written already, a failure here must not reach the scheduler
+        try:
+            self.apply_uses(pending_uses)
+        except:
+            log.exception("Failed to update the loaded command uses")
+
+    def flush_uses_now(self):
+        """ Blocking flush, used when the event loop is going away """
+        if not self.pending_uses:
+            return
+
+        pending_uses = self.take_uses()
+        try:
+            with DBManager.create_session_scope() as db_session:
+                CommandData._add_uses(db_session, pending_uses)
+        except:
+            self.requeue_uses(pending_uses)
+
     def load_internal_commands(self):
         if self.internal_commands:
             return self.internal_commands
@@ -104,6 +306,14 @@ class CommandManager(UserDict):
             description="Shut down the bot, this will most definitely restart it if set up properly",
             can_execute_with_whisper=True,
         )
+        self.internal_commands["latency"] = Command.greenbot_command(
+            self.bot,
+            "latency",
+            level=1500,
+            command="latency",
+            description="Shows p50/p95/p99 latencies for each stage of the message pipeline, use !latency reset to clear them",
+            can_execute_with_whisper=True,
+        )
         self.internal_commands["add"] = Command.multiaction_command(
             level=100,
             delay_all=0,
@@ -168,6 +378,7 @@ class CommandManager(UserDict):
         self.internal_commands["rem"] = self.internal_commands["remove"]
         self.internal_commands["del"] = self.internal_commands["remove"]
         self.internal_commands["delete"] = self.internal_commands["remove"]
+        assign_cooldown_keys("internal", self.internal_commands)
 
         return self.internal_commands
 
@@ -191,10 +402,11 @@ class CommandManager(UserDict):
         self.db_session.add(command.data)
         self.commit()
 
-        self.rebuild()
+        self.update_aliases(command.aliases)
         return command, True, ""
 
     def edit_command(self, command_to_edit, **options):
+        aliases = set(command_to_edit.aliases)
         if "group" in options:
             self.remove_command_aliases(command_to_edit)
         command_to_edit.set(**options)
@@ -203,7 +415,7 @@ class CommandManager(UserDict):
         if "group" in options:
             self.add_db_command_aliases(command_to_edit)
         self.commit()
-        self.rebuild()
+        self.update_aliases(aliases | set(command_to_edit.aliases))
 
     def remove_command_aliases(self, command):
         aliases = command.aliases
@@ -223,7 +435,7 @@ class CommandManager(UserDict):
             db_session.delete(command.data)
             db_session.delete(command)
 
-        self.rebuild()
+        self.update_aliases(command.aliases)
 
     def add_db_command_aliases(self, command):
         aliases = command.aliases
@@ -261,9 +473,11 @@ class CommandManager(UserDict):
 
     def rebuild(self):
         """ Rebuild the internal commands list from all sources.
-
+        Only used as a fallback, changes to a single command or module go through update_aliases.
         """
 
+        start = time.perf_counter()
+
         def merge_commands(in_dict, out):
             for alias, command in in_dict.items():
                 if command.action:
@@ -272,18 +486,7 @@ class CommandManager(UserDict):
                     # command list.
                     command.action.reset()
 
-                if alias in out:
-                    if (
-                        command.action
-                        and command.action.type == "multi"
-                        and out[alias].action
-                        and out[alias].action.type == "multi"
-                    ):
-                        out[alias].action += command.action
-                    else:
-                        out[alias] = command
-                else:
-                    out[alias] = command
+                merge_command(alias, command, out)
 
         self.data = {}
         db_commands = {
@@ -294,9 +497,115 @@ class CommandManager(UserDict):
 
         merge_commands(self.internal_commands, self.data)
         merge_commands(db_commands, self.data)
+        self.module_aliases = {}
         if self.module_manager is not None:
             for enabled_module in self.module_manager.modules:
+                assign_cooldown_keys(f"mod:{enabled_module.ID}", enabled_module.commands)
                 merge_commands(enabled_module.commands, self.data)
+                self.module_aliases[enabled_module.ID] = set(enabled_module.commands)
+
+        self.resolver = CommandResolver(self.data)
+
+        log.info(
+            f"Rebuilt {len(self.data)} commands in {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
+
+    def command_sources(self):
+        """ All the alias -> command dicts, in the order they are merged """
+        sources = [self.internal_commands, self.db_commands]
+        if self.module_manager is not None:
+            sources += [
+                enabled_module.commands for enabled_module in self.module_manager.modules
+            ]
+        return sources
+
+    def merge_candidates(self, alias):
+        """ Every command registered under alias, in the order they are merged """
+        candidates = []
+        for source in self.command_sources():
+            command = source.get(alias, None)
+            if command is None:
+                continue
+            if source is self.db_commands and command.enabled is not True:
+                continue
+            candidates.append(command)
+        return candidates
+
+    def expand_shared_aliases(self, aliases):
+        """
+        Multi actions are merged into in place, so once one of them is reset
+        every other alias it is registered under has to be merged again too
+        """
+        aliases = set(aliases)
+        pending = set(aliases)
+        while pending:
+            shared = set()
+            for alias in pending:
+                for command in self.merge_candidates(alias) + [self.data.get(alias, None)]:
+                    if is_multi(command):
+                        shared.add(command)
+            if not shared:
+                break
+
+            pending = {
+                alias
+                for source in self.command_sources()
+                for alias, command in source.items()
+                if command in shared and alias not in aliases
+            }
+            aliases |= pending
+        return aliases
+
+    def update_aliases(self, aliases):
+        """ Merges the given aliases again and applies them to self.data and the resolver """
+        try:
+            aliases = self.expand_shared_aliases(aliases)
+
+            # Like in rebuild, every action is reset before anything is merged into it
+            for alias in aliases:
+                self.data.pop(alias, None)
+                for command in self.merge_candidates(alias):
+                    if command.action:
+                        command.action.reset()
+
+            # and the sources are merged one after the other, since a multi action
+            # can be merged into another one after something was merged into it
+            for source in self.command_sources():
+                for alias in aliases:
+                    command = source.get(alias, None)
+                    if command is None:
+                        continue
+                    if source is self.db_commands and command.enabled is not True:
+                        continue
+                    merge_command(alias, command, self.data)
+
+            for alias in aliases:
+                command = self.data.get(alias, None)
+                if command is None:
+                    self.resolver.remove(alias)
+                else:
+                    self.resolver.add(alias, command)
+        except:
+            log.exception("Failed to update the commands incrementally")
+            self.rebuild()
+
+    def update_module(self, module_id):
+        """ Applies a module being enabled, disabled or reloaded """
+        if module_id is None or self.module_manager is None:
+            self.rebuild()
+            return
+
+        aliases = self.module_aliases.pop(module_id, set())
+        module = find(lambda m: m.ID == module_id, self.module_manager.modules)
+        if module is not None:
+            assign_cooldown_keys(f"mod:{module_id}", module.commands)
+            self.module_aliases[module_id] = set(module.commands)
+            aliases = aliases | self.module_aliases[module_id]
+
+        self.update_aliases(aliases)
+
+    def resolve(self, content, prefix):
+        return self.resolver.resolve(content, prefix)
 
     def load(self, **options):
         self.load_internal_commands()
@@ -322,6 +631,7 @@ class CommandManager(UserDict):
                 )
                 command.data = CommandData(command.id)
             self.db_session.add(command.data)
+        return command
 
     def parse_for_web(self):
         commands = []
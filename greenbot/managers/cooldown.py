@@ -0,0 +1,175 @@
+import heapq
+import logging
+import time
+
+from greenbot.managers.redis import RedisManager
+
+log = logging.getLogger(__name__)
+
+
+class MemoryCooldownStore:
+    """ Keeps the cooldowns in this process, entries are evicted once they expire """
+
+    MAX_SIZE = 100000
+
+    def __init__(self):
+        # key: (last run, expiry)
+        self.entries = {}
+        # (expiry, key), entries that were overwritten since are skipped when popped
+        self.expiries = []
+
+    def get(self, keys):
+        now = time.time()
+        last_runs = []
+        for key in keys:
+            entry = self.entries.get(key, None)
+            if entry is None or entry[1] <= now:
+                last_runs.append(None)
+            else:
+                last_runs.append(entry[0])
+        return last_runs
+
+    def set(self, entries):
+        now = time.time()
+        for key, last_run, duration in entries:
+            expiry = now + duration
+            self.entries[key] = (last_run, expiry)
+            heapq.heappush(self.expiries, (expiry, key))
+
+        self.prune(now)
+
+    def claim(self, entries, cur_time, modifier, force):
+        last_runs = [last_run or 0 for last_run in self.get([key for key, _ in entries])]
+        if not force and any(
+            (cur_time - last_run) / modifier < duration
+            for (_, duration), last_run in zip(entries, last_runs)
+        ):
+            return False, last_runs
+
+        self.set(
+            [(key, cur_time, duration) for key, duration in entries if duration > 0]
+        )
+        return True, last_runs
+
+    def release(self, keys, last_run):
+        for key in keys:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] == last_run:
+                del self.entries[key]
+
+    def prune(self, now):
+        """ Evicts the expired entries, and the ones closest to expiring while there are too many """
+        while self.expiries:
+            expiry, key = self.expiries[0]
+            if expiry > now and len(self.entries) <= self.MAX_SIZE:
+                break
+            heapq.heappop(self.expiries)
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[1] == expiry:
+                del self.entries[key]
+
+        # Overwritten entries leave stale expiries behind, drop them once they pile up
+        if len(self.expiries) > 2 * len(self.entries) + 1000:
+            self.expiries = [(expiry, key) for key, (_, expiry) in self.entries.items()]
+            heapq.heapify(self.expiries)
+
+
+class RedisCooldownStore:
+    """ Keeps the cooldowns in redis so they survive restarts and can be shared between processes """
+
+    # Checks the cooldowns and starts them in one step, so two processes can't both run the command.
+    # KEYS are the cooldown keys, ARGV is the time of the run, the cooldown modifier,
+    # 1 to skip the check and then the duration (in ms) of each key
+    CLAIM_SCRIPT = """
+local cur_time = tonumber(ARGV[1])
+local modifier = tonumber(ARGV[2])
+local last_runs = {}
+local claimed = 1
+for i, key in ipairs(KEYS) do
+    local last_run = redis.call("GET", key) or "0"
+    last_runs[i] = last_run
+    if ARGV[3] ~= "1" and (cur_time - tonumber(last_run)) / modifier * 1000 < tonumber(ARGV[3 + i]) then
+        claimed = 0
+    end
+end
+if claimed == 1 then
+    for i, key in ipairs(KEYS) do
+        if tonumber(ARGV[3 + i]) > 0 then
+            redis.call("SET", key, ARGV[1], "PX", ARGV[3 + i])
+        end
+    end
+end
+return {claimed, unpack(last_runs)}
+"""
+
+    # Ends the cooldowns again, unless another run claimed them in the meantime
+    RELEASE_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if redis.call("GET", key) == ARGV[1] then
+        redis.call("DEL", key)
+    end
+end
+"""
+
+    def __init__(self, bot_name):
+        self.prefix = f"{bot_name}:cooldowns:"
+        self.claim_script = RedisManager.get().register_script(self.CLAIM_SCRIPT)
+        self.release_script = RedisManager.get().register_script(self.RELEASE_SCRIPT)
+
+    def claim(self, entries, cur_time, modifier, force):
+        claimed, *last_runs = self.claim_script(
+            keys=[f"{self.prefix}{key}" for key, _ in entries],
+            args=[repr(cur_time), modifier, 1 if force else 0]
+            + [int(duration * 1000) for _, duration in entries],
+        )
+        return claimed == 1, [float(last_run) for last_run in last_runs]
+
+    def release(self, keys, last_run):
+        self.release_script(
+            keys=[f"{self.prefix}{key}" for key in keys], args=[repr(last_run)]
+        )
+
+
+class CooldownManager:
+    """
+    Remembers when each command was last run, globally and by each user.
+    An entry only lives as long as the cooldown it is for.
+    The store is picked with store = memory|redis in the [cooldowns] section of the config
+    """
+
+    def __init__(self, bot):
+        store = bot.config.get("cooldowns", "store", fallback="memory")
+        if store == "redis":
+            self.store = RedisCooldownStore(bot.bot_name)
+        else:
+            if store != "memory":
+                log.warning(f"Unknown cooldown store {store}, using memory")
+            self.store = MemoryCooldownStore()
+
+    @staticmethod
+    def keys(command, user_id):
+        # Commands without a database id are given a cooldown_key when the CommandManager loads them
+        if command.id is not None:
+            name = f"id{command.id}"
+        else:
+            name = command.cooldown_key or command.command
+        return f"{name}:all", f"{name}:{user_id}"
+
+    def claim(self, command, user_id, cur_time, modifier, force=False):
+        """
+        Checks the cooldowns of the command and, if they are over, starts them in the same step.
+        Returns whether the run may go ahead, and when the command was last run by anyone
+        and by the user (0 if the cooldown is over)
+        """
+        all_key, user_key = self.keys(command, user_id)
+        claimed, (last_run, last_run_by_user) = self.store.claim(
+            [(all_key, command.delay_all), (user_key, command.delay_user)],
+            cur_time,
+            modifier,
+            force,
+        )
+        return claimed, last_run, last_run_by_user
+
+    def release(self, command, user_id, cur_time):
+        """ Ends the cooldowns claimed at cur_time, used when the command didn't run after all """
+        self.store.release(self.keys(command, user_id), cur_time)
@@ -1,4 +1,7 @@
+import asyncio
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 from psycopg2.extensions import STATUS_IN_TRANSACTION
@@ -9,6 +12,8 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 
+from greenbot.managers.latency import LatencyManager
+
 Base = declarative_base()
 
 log = logging.getLogger("greenbot")
@@ -27,6 +32,13 @@ class DBManager:
     Session = None
     ScopedSession = None
 
+    # Threads used by DBManager.run, kept below the size of the connection pool
+    POOL_THREADS = 8
+    # Waiting longer than this (in seconds) for a free thread gets logged
+    SLOW_WAIT = 1.0
+    executor = None
+    pool_stats = {"runs": 0, "wait_total": 0.0, "wait_max": 0.0}
+
     @staticmethod
     def init(url):
         DBManager.engine = create_engine(
@@ -45,6 +57,39 @@ class DBManager:
         DBManager.Session = sessionmaker(bind=DBManager.engine, autoflush=False)
         DBManager.ScopedSession = scoped_session(sessionmaker(bind=DBManager.engine))
 
+    @staticmethod
+    async def run(fn, *args, **kwargs):
+        """
+        Runs fn(db_session, *args, **kwargs) inside a session scope on the
+        database thread pool, so the event loop isn't blocked while it waits for postgres.
+        fn must not return ORM objects, they are detached (and expired) once the scope is closed.
+        """
+
+        if DBManager.executor is None:
+            DBManager.executor = ThreadPoolExecutor(
+                max_workers=DBManager.POOL_THREADS, thread_name_prefix="DBManager"
+            )
+
+        queued_at = time.monotonic()
+
+        def run_in_session_scope():
+            DBManager.record_pool_wait(time.monotonic() - queued_at)
+            with DBManager.create_session_scope() as db_session:
+                return fn(db_session, *args, **kwargs)
+
+        return await asyncio.get_event_loop().run_in_executor(
+            DBManager.executor, run_in_session_scope
+        )
+
+    @staticmethod
+    def record_pool_wait(wait):
+        LatencyManager.record("db_pool_wait", wait)
+        DBManager.pool_stats["runs"] += 1
+        DBManager.pool_stats["wait_total"] += wait
+        DBManager.pool_stats["wait_max"] = max(DBManager.pool_stats["wait_max"], wait)
+        if wait > DBManager.SLOW_WAIT:
+            log.warning(f"Waited {wait * 1000.0:.3f} ms for a free database thread")
+
     @staticmethod
     def create_session(**options):
         """
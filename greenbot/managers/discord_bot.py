@@ -12,6 +12,7 @@ from greenbot.models.message import Message
 from greenbot.managers.db import DBManager
 from greenbot.managers.schedule import ScheduleManager
 from greenbot.managers.handler import HandlerManager
+from greenbot.managers.latency import LatencyManager
 import greenbot.utils as utils
 
 log = logging.getLogger("greenbot")
@@ -61,7 +62,8 @@ class CustomClient(discord.Client):
         )
 
     async def on_message(self, message):
-        await HandlerManager.trigger("discord_message", message=message)
+        with LatencyManager.time("total"):
+            await HandlerManager.trigger("discord_message", message=message)
 
     async def on_message_delete(self, message):
         await HandlerManager.trigger("discord_message_delete", message=message)
@@ -304,7 +306,8 @@ class DiscordBotManager:
             message = discord.utils.escape_markdown(message, as_needed=True)
         if not channel or (message is None and embed is None and file is None):
             return
-        return await channel.send(content=message, embed=embed, file=file)
+        with LatencyManager.time("discord_send"):
+            return await channel.send(content=message, embed=embed, file=file)
 
     async def ban(self, user, timeout_in_seconds=0, reason=None, delete_message_days=0):
         delete_message_days = (
@@ -411,8 +414,9 @@ class DiscordBotManager:
         try:
             if message and not ignore_escape:
                 message = discord.utils.escape_markdown(message, as_needed=True)
-            await user.create_dm()
-            return await user.dm_channel.send(content=message, embed=embed, file=file)
+            with LatencyManager.time("discord_send"):
+                await user.create_dm()
+                return await user.dm_channel.send(content=message, embed=embed, file=file)
         except:
             return None
 
@@ -0,0 +1,109 @@
+import bisect
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from greenbot.managers.redis import RedisManager
+
+log = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    # Upper bounds of the buckets, in milliseconds. Anything slower lands in the last bucket
+    BUCKETS = [
+        0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+    ]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, milliseconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, percent):
+        """ Returns the upper bound of the bucket the given percentile falls into """
+        if self.count == 0:
+            return 0.0
+
+        needed = self.count * percent / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= needed:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else self.max
+        return self.max
+
+    def jsonify(self):
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class LatencyManager:
+    """
+    Collects latency histograms for each stage of the message pipeline.
+    The summary is published to redis so the web interface can show it.
+    """
+
+    histograms = {}
+    bot_name = None
+
+    # How often (in seconds) the summary is written to redis
+    PUBLISH_INTERVAL = 60
+
+    @staticmethod
+    def init(bot_name):
+        LatencyManager.bot_name = bot_name
+        LatencyManager.histograms = {}
+
+    @staticmethod
+    def record(stage, seconds):
+        histogram = LatencyManager.histograms.get(stage, None)
+        if histogram is None:
+            histogram = LatencyManager.histograms[stage] = LatencyHistogram()
+        histogram.record(seconds * 1000.0)
+
+    @staticmethod
+    @contextmanager
+    def time(stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            LatencyManager.record(stage, time.perf_counter() - start)
+
+    @staticmethod
+    def summary():
+        return {
+            stage: histogram.jsonify()
+            for stage, histogram in LatencyManager.histograms.items()
+        }
+
+    @staticmethod
+    def redis_key(bot_name):
+        return f"{bot_name}:latency"
+
+    @staticmethod
+    async def publish():
+        if LatencyManager.bot_name is None:
+            return
+
+        try:
+            RedisManager.get().set(
+                LatencyManager.redis_key(LatencyManager.bot_name),
+                json.dumps(LatencyManager.summary()),
+            )
+        except:
+            log.exception("Failed to publish latency summary")
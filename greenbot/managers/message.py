@@ -1,24 +1,63 @@
+import asyncio
 import logging
 import discord
 
+from collections import OrderedDict
+from datetime import timedelta
+import json
+
 from greenbot.managers.handler import HandlerManager
 from greenbot.managers.db import DBManager
+from greenbot.managers.latency import LatencyManager
+from greenbot.managers.schedule import ScheduleManager
 from greenbot.managers.timeout import TimeoutManager
 from greenbot.models.message import Message
-from greenbot.models.user import User
-from greenbot.models.timeout import Timeout
 from greenbot.models.banphrase import BanphraseManager
+import greenbot.utils as utils
+from greenbot.utils import NormalizedContent
 
 log = logging.getLogger(__name__)
 
 
 class MessageManager:
+    # Pending messages are written once this many are buffered
+    FLUSH_SIZE = 100
+    # or at least this often (in seconds)
+    FLUSH_INTERVAL = 5
+    # Hard cap on the buffer, the oldest messages are dropped past this point
+    MAX_PENDING = 5000
+    # Partitions of the message table are created this many days ahead
+    PARTITION_DAYS_AHEAD = 7
+    # Default for [messages] retention_days, older partitions are dropped or archived.
+    # 0 keeps the messages forever, expiring them has to be opted into
+    RETENTION_DAYS = 0
+    # How often (in seconds) the partitions are maintained
+    PARTITION_INTERVAL = 60 * 60
+
     def __init__(self, bot):
         self.bot = bot
+        self.pending_messages = OrderedDict()
         HandlerManager.add_handler("discord_message", self.on_message)
         HandlerManager.add_handler(
             "discord_raw_message_edit", self.edit_message, priority=1000
         )
+        HandlerManager.add_handler(
+            "discord_raw_message_delete", self.on_message_delete, priority=1000
+        )
+        self.flush_lock = asyncio.Lock()
+        self.flush_job = ScheduleManager.execute_every(
+            self.FLUSH_INTERVAL, self.flush
+        )
+
+        self.retention_days = bot.config.getint(
+            "messages", "retention_days", fallback=self.RETENTION_DAYS
+        )
+        self.archive_expired = bot.config.getboolean(
+            "messages", "archive_expired", fallback=False
+        )
+        self.partition_job = ScheduleManager.execute_every(
+            self.PARTITION_INTERVAL, self.maintain_partitions
+        )
 
     async def on_message(self, message):
         member = self.bot.discord_bot.get_member(message.author.id)
@@ -29,64 +68,191 @@ class MessageManager:
         if not member:
             return
 
-        with DBManager.create_session_scope() as db_session:
-            User._create_or_get_by_discord_id(db_session, str(member.id), str(member))
-            db_session.commit()
-            if self.new_message(db_session, message) is None:
-                log.error("Discord api running slow?")
-                return
+        with LatencyManager.time("user_upsert"):
+            await self.bot.user_manager.fetch(member.id, str(member))
 
-            db_session.commit()
-            current_timeout = Timeout._is_timedout(db_session, str(member.id))
-            if current_timeout and not_whisper:
-                await message.delete()
-                await self.bot.timeout_manager.apply_timeout(member, current_timeout)
-                return
+        with LatencyManager.time("message_insert"):
+            new_message = self.new_message(message)
+        if new_message is None:
+            log.error("Discord api running slow?")
+            return
 
-            user_level = self.bot.psudo_level_member(db_session, member)
+        with LatencyManager.time("timeout_check"):
+            current_timeout = self.bot.timeout_manager.is_timedout(member.id)
+        if current_timeout and not_whisper:
+            await message.delete()
+            await self.bot.timeout_manager.apply_timeout(member, current_timeout)
+            return
+
+        with LatencyManager.time("level_resolution"):
+            user_level = await self.bot.psudo_level_member(None, member)
         if message.author.id == self.bot.discord_bot.client.user.id:
             return
 
+        # Shared by the content filters so each view of the content is only computed once
+        content = NormalizedContent(message.content)
         if user_level < 500:
-            matched_phrase = self.bot.banphrase_manager.check_message(message.content)
+            with LatencyManager.time("banphrase_match"):
+                matched_phrase = self.bot.banphrase_manager.check_message(content)
             if matched_phrase:
                 await self.bot.banphrase_manager.punish(member, matched_phrase)
                 await message.delete()
                 return
 
-        await HandlerManager.trigger(
-            "parse_command_from_message",
-            message=message,
-            content=message.content,
-            user_level=user_level,
-            author=message.author,
-            not_whisper=not_whisper,
-            channel=message.channel,
-        )
+        with LatencyManager.time("command_dispatch"):
+            await HandlerManager.trigger(
+                "parse_command_from_message",
+                message=message,
+                content=message.content,
+                user_level=user_level,
+                author=message.author,
+                not_whisper=not_whisper,
+                channel=message.channel,
+            )
 
-    def new_message(self, db_session, message):
-        return Message._create(
-            db_session,
-            message.id,
-            message.author.id,
-            message.channel.id if isinstance(message.author, discord.Member) else None,
-            [message.content],
-        )
+    def new_message(self, message):
+        """ Buffers the message, it is written to the database on the next flush """
+        message_id = str(message.id)
+        if message_id in self.pending_messages:
+            return None
 
-    async def edit_message(self, payload):
-        with DBManager.create_session_scope() as db_session:
-            message = Message._get(db_session, payload.message_id)
-            if not message:
+        if len(self.pending_messages) >= self.MAX_PENDING:
+            dropped_id, _ = self.pending_messages.popitem(last=False)
+            log.warning(f"Message buffer is full, dropping message {dropped_id}")
+
+        pending_message = {
+            "message_id": message_id,
+            "user_id": str(message.author.id),
+            "channel_id": str(
+                message.channel.id
+                if isinstance(message.author, discord.Member)
+                else None
+            ),
+            "content": [message.content],
+            "time_sent": utils.now(),
+        }
+        self.pending_messages[message_id] = pending_message
+        if len(self.pending_messages) >= self.FLUSH_SIZE:
+            self.bot.private_loop.create_task(self.flush())
+
+        return pending_message
+
+    def take_pending(self):
+        pending_messages = self.pending_messages
+        self.pending_messages = OrderedDict()
+        rows = [
+            {**pending_message, "content": json.dumps(pending_message["content"])}
+            for pending_message in pending_messages.values()
+        ]
+        return pending_messages, rows
+
+    def requeue(self, pending_messages):
+        log.exception(f"Failed to write {len(pending_messages)} messages, requeueing them")
+        pending_messages.update(self.pending_messages)
+        self.pending_messages = pending_messages
+        if len(self.pending_messages) > self.MAX_PENDING:
+            log.warning(
+                f"Message buffer is full, dropping the {len(self.pending_messages) - self.MAX_PENDING} oldest messages"
+            )
+        while len(self.pending_messages) > self.MAX_PENDING:
+            self.pending_messages.popitem(last=False)
+
+    def log_failed(self, rows, failed):
+        if failed:
+            log.error(
+                f"Dropped {len(failed)} of {len(rows)} messages that could not be written: {', '.join(failed)}"
+            )
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending_messages:
+                return
+
+            pending_messages, rows = self.take_pending()
+            try:
+                await DBManager.run(Message._create_many, rows)
+                return
+            except:
+                log.exception(f"Failed to write {len(rows)} messages, retrying them one by one")
+
+            # Only the rows that fail on their own are dropped, the rest of the batch
+            # is kept back if the database itself is unavailable
+            try:
+                failed = await DBManager.run(Message._create_each, rows)
+            except:
+                self.requeue(pending_messages)
                 return
+            self.log_failed(rows, failed)
+
+    def flush_now(self):
+        """ Blocking flush, used when the event loop is going away """
+        if not self.pending_messages:
+            return
+
+        pending_messages, rows = self.take_pending()
+        try:
+            with DBManager.create_session_scope() as db_session:
+                Message._create_many(db_session, rows)
+            return
+        except:
+            log.exception(f"Failed to write {len(rows)} messages, retrying them one by one")
+
+        try:
+            with DBManager.create_session_scope() as db_session:
+                failed = Message._create_each(db_session, rows)
+        except:
+            self.requeue(pending_messages)
+            return
+        self.log_failed(rows, failed)
+
+    async def maintain_partitions(self):
+        today = utils.now().date()
+        try:
+            await DBManager.run(
+                Message._create_partitions, today, self.PARTITION_DAYS_AHEAD + 1
+            )
+            if self.retention_days <= 0:
+                return
+
+            expired = await DBManager.run(
+                Message._expire_partitions,
+                today - timedelta(days=self.retention_days),
+                self.archive_expired,
+            )
+        except:
+            log.exception("Failed to maintain the message partitions")
+            return
 
-            new_content = payload.data.get("content", "")
-            message.edit_message(db_session, new_content)
-            member = self.bot.discord_bot.get_member(message.user_id)
-            user_level = self.bot.psudo_level_member(db_session, member) if member else 0
-            if user_level < 500:
-                matched_phrase = self.bot.banphrase_manager.check_message(new_content)
-                if matched_phrase:
-                    await self.bot.banphrase_manager.punish(member, matched_phrase)
-                    channel = await self.bot.discord_bot.get_channel(message.channel_id)
-                    message = await channel.fetch_message(int(message.message_id))
-                    await message.delete()
+        if expired:
+            action = "Archived" if self.archive_expired else "Dropped"
+            log.info(f"{action} message partitions {', '.join(expired)}")
+
+    def is_pending(self, message_id):
+        return str(message_id) in self.pending_messages or self.flush_lock.locked()
+
+    async def on_message_delete(self, payload):
+        # Make sure handlers further down can look the message up
+        if self.is_pending(payload.message_id):
+            await self.flush()
+
+    async def edit_message(self, payload):
+        if self.is_pending(payload.message_id):
+            await self.flush()
+
+        new_content = payload.data.get("content", "")
+        edited_message = await DBManager.run(
+            Message._edit, payload.message_id, new_content
+        )
+        if not edited_message:
+            return
+
+        user_id, channel_id = edited_message
+        member = self.bot.discord_bot.get_member(user_id)
+        user_level = await self.bot.psudo_level_member(None, member) if member else 0
+        if user_level < 500:
+            matched_phrase = self.bot.banphrase_manager.check_message(new_content)
+            if matched_phrase:
+                await self.bot.banphrase_manager.punish(member, matched_phrase)
+                channel = await self.bot.discord_bot.get_channel(channel_id)
+                message = await channel.fetch_message(int(payload.message_id))
+                await message.delete()
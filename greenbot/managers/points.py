@@ -0,0 +1,131 @@
+import asyncio
+import logging
+
+from greenbot.managers.db import DBManager
+from greenbot.managers.schedule import ScheduleManager
+from greenbot.models.points_transaction import PointsTransaction
+from greenbot.models.user import User
+import greenbot.utils as utils
+
+log = logging.getLogger(__name__)
+
+
+class PointsManager:
+    """
+    Changes user points with single atomic UPDATE statements so concurrent
+    commands can't overspend, and keeps an append-only ledger of every change.
+    The ledger rows are buffered and written in batches.
+    """
+
+    # Pending transactions are written at least this often (in seconds)
+    FLUSH_INTERVAL = 10
+    # or once this many are buffered
+    FLUSH_SIZE = 200
+    # Hard cap on the buffer, the oldest transactions are dropped past this point
+    MAX_PENDING = 10000
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.pending_transactions = []
+        self.flush_lock = asyncio.Lock()
+        self.flush_job = ScheduleManager.execute_every(
+            self.FLUSH_INTERVAL, self.flush
+        )
+
+    def record(self, discord_id, amount, reason, balance=None):
+        """ Adds a row to the ledger, it is written to the database on the next flush """
+        if len(self.pending_transactions) >= self.MAX_PENDING:
+            self.pending_transactions.pop(0)
+            log.warning("Points ledger buffer is full, dropping the oldest transaction")
+
+        self.pending_transactions.append(
+            {
+                "user_id": str(discord_id),
+                "amount": amount,
+                "balance": balance,
+                "reason": reason,
+                "created_at": utils.now(),
+            }
+        )
+        if len(self.pending_transactions) >= self.FLUSH_SIZE:
+            self.bot.private_loop.create_task(self.flush())
+
+    def update_cache(self, discord_id, points):
+        user = self.bot.user_manager.users.get(str(discord_id), None)
+        if user is None:
+            return
+
+        if points is None:
+            self.bot.user_manager.invalidate(discord_id)
+        else:
+            user.points = points
+
+    async def spend(self, discord_id, cost, reason):
+        """ Takes cost points from the user, returns the new balance or None if they can't afford it """
+        balance = await DBManager.run(User._spend_points, discord_id, cost)
+        if balance is None:
+            # The cached balance was stale, make sure the next check reloads it
+            self.bot.user_manager.invalidate(discord_id)
+            return None
+
+        self.update_cache(discord_id, balance)
+        self.record(discord_id, -cost, reason, balance)
+        return balance
+
+    async def adjust(self, discord_id, amount, reason):
+        """ Adds amount (which may be negative) to the users points, returns the new balance """
+        balance = await DBManager.run(User._add_points, discord_id, amount)
+        self.update_cache(discord_id, balance)
+        if balance is not None:
+            self.record(discord_id, amount, reason, balance)
+        return balance
+
+    async def refund(self, discord_id, amount, reason):
+        return await self.adjust(discord_id, amount, reason)
+
+    async def set_balance(self, discord_id, points, reason):
+        """ Sets the users points, returns the previous balance """
+        previous = await DBManager.run(User._set_points, discord_id, points)
+        if previous is None:
+            self.update_cache(discord_id, None)
+            return None
+
+        self.update_cache(discord_id, points)
+        if previous != points:
+            self.record(discord_id, points - previous, reason, points)
+        return previous
+
+    def take_pending(self):
+        pending_transactions = self.pending_transactions
+        self.pending_transactions = []
+        return pending_transactions
+
+    def requeue(self, pending_transactions):
+        log.exception(
+            f"Failed to write {len(pending_transactions)} points transactions, requeueing them"
+        )
+        self.pending_transactions = pending_transactions + self.pending_transactions
+        del self.pending_transactions[: -self.MAX_PENDING]
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending_transactions:
+                return
+
+            pending_transactions = self.take_pending()
+            try:
+                await DBManager.run(PointsTransaction._create_many, pending_transactions)
+            except:
+                self.requeue(pending_transactions)
+
+    def flush_now(self):
+        """ Blocking flush, used when the event loop is going away """
+        if not self.pending_transactions:
+            return
+
+        pending_transactions = self.take_pending()
+        try:
+            with DBManager.create_session_scope() as db_session:
+                PointsTransaction._create_many(db_session, pending_transactions)
+        except:
+            self.requeue(pending_transactions)
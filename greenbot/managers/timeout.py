@@ -23,22 +23,31 @@ class TimeoutManager:
             "punished_role_id": "",
         }
         self.salt = ""
+        # user_id -> id of the users active timeout
+        self.active_timeouts = {}
 
     def enable(self, settings):
         self.settings = settings
         self.salt = utils.random_string()
+        self.active_timeouts = {}
         with DBManager.create_session_scope() as db_session:
             current_timeouts = Timeout._active_timeouts(db_session)
             for timeout in current_timeouts:
+                self.active_timeouts[timeout.user_id] = timeout.id
                 if timeout.time_left:
                     ScheduleManager.execute_delayed(
                         timeout.time_left + 1,
                         self.auto_untimeout,
                         args=[timeout.id, self.salt],
                     )
+
     def update_settings(self, settings):
         self.settings = settings
 
+    def is_timedout(self, user_id):
+        """ Returns the id of the users active timeout, without touching the database """
+        return self.active_timeouts.get(str(user_id), None)
+
     def disable(self):
         self.settings = {
             "enabled": False,
@@ -48,6 +57,7 @@ class TimeoutManager:
             "punished_role_id": "",
         }
         self.salt = None
+        self.active_timeouts = {}
 
     async def auto_untimeout(self, timeout_id, salt):
         if self.salt != salt:
@@ -63,6 +73,8 @@ class TimeoutManager:
                 await self.untimeout_user(db_session, member, None, "Timeout removed by timer")
                 return
             timeout.unban(db_session, None, "Timeout removed by timer")
+            if self.active_timeouts.get(timeout.user_id, None) == timeout.id:
+                del self.active_timeouts[timeout.user_id]
             if self.settings["log_untimeout"]:  # TODO
                 pass
         return
@@ -95,7 +107,8 @@ class TimeoutManager:
                 db_session, str(member.id), str(banner.id), until, ban_reason
             )
             db_session.commit()
-        await self.apply_timeout(member, new_timeout)
+        self.active_timeouts[str(member.id)] = new_timeout.id
+        await self.apply_timeout(member, new_timeout.id)
 
         if self.settings["log_timeout"]:
             embed = discord.Embed(
@@ -147,6 +160,7 @@ class TimeoutManager:
             db_session, str(unbanner.id) if unbanner else None, unban_reason
         )
         db_session.commit()
+        self.active_timeouts.pop(str(member.id), None)
         role = self.bot.filters.get_role([self.settings["punished_role_id"]], None, {})[0]
         await self.bot.remove_role(member, role, f"Untimedout by Timeout #{current_timeout.id}")
 
@@ -205,9 +219,9 @@ class TimeoutManager:
             await HandlerManager.trigger("aml_custom_log", embed=embed)
         return True, None
 
-    async def apply_timeout(self, member, timeout):
+    async def apply_timeout(self, member, timeout_id):
         if not self.settings["enabled"]:
             return False, "Module is not enabled"
 
         role = self.bot.filters.get_role([self.settings["punished_role_id"]], None, {})[0]
-        await self.bot.add_role(member, role, f"Timedout by Timeout #{timeout.id}")
+        await self.bot.add_role(member, role, f"Timedout by Timeout #{timeout_id}")
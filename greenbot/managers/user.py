@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+
+from greenbot.managers.db import DBManager
+from greenbot.models.user import User
+
+log = logging.getLogger(__name__)
+
+
+class CachedUser:
+    def __init__(self, discord_id, user_name, points, level):
+        self.discord_id = discord_id
+        self.user_name = user_name
+        self.points = points
+        self.level = level
+
+    def can_afford(self, points):
+        return not self.points < points
+
+    def jsonify(self):
+        return {
+            "discord_id": self.discord_id,
+            "points": self.points,
+            "level": self.level,
+            "user_name": self.user_name,
+        }
+
+
+class UserManager:
+    """
+    Keeps the most recently seen users in memory so the message and command
+    paths don't have to query the user table every time.
+    Anything that changes a user outside of this manager must call invalidate,
+    or publish user.update when it runs in another process.
+    """
+
+    MAX_SIZE = 10000
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.users = OrderedDict()
+        self.loading = {}
+
+        if self.bot:
+            self.bot.socket_manager.add_handler("user.update", self.on_user_update)
+
+    async def on_user_update(self, data):
+        try:
+            discord_id = str(data["discord_id"])
+        except KeyError:
+            log.warning("No discord ID found in on_user_update")
+            return
+
+        self.invalidate(discord_id)
+
+    async def fetch(self, discord_id, user_name=""):
+        """
+        Returns the cached user, creating the row in the database if it doesn't exist yet.
+        Any database work is done on the DBManager thread pool
+        """
+        discord_id = str(discord_id)
+        user = self.users.get(discord_id, None)
+        if user is None:
+            if discord_id not in self.loading:
+                self.loading[discord_id] = asyncio.ensure_future(
+                    DBManager.run(UserManager.load_user, discord_id, user_name)
+                )
+            try:
+                return self.add(await self.loading[discord_id])
+            finally:
+                self.loading.pop(discord_id, None)
+
+        self.users.move_to_end(discord_id)
+        if user_name and user.user_name != user_name:
+            user.user_name = user_name
+            await DBManager.run(User._update, discord_id, user_name=user_name)
+        return user
+
+    @staticmethod
+    def load_user(db_session, discord_id, user_name):
+        db_user = User._create_or_get_by_discord_id(db_session, discord_id, user_name)
+        return CachedUser(
+            db_user.discord_id, db_user.user_name, db_user.points, db_user.level
+        )
+
+    def add(self, user):
+        self.users[user.discord_id] = user
+        if len(self.users) > self.MAX_SIZE:
+            self.users.popitem(last=False)
+        return user
+
+    async def set(self, discord_id, **fields):
+        """ Updates the given fields, only the ones that changed are written to the database """
+        user = await self.fetch(discord_id)
+        dirty_fields = {
+            key: value for key, value in fields.items() if getattr(user, key) != value
+        }
+        if not dirty_fields:
+            return user
+
+        for key, value in dirty_fields.items():
+            setattr(user, key, value)
+
+        try:
+            await DBManager.run(User._update, user.discord_id, **dirty_fields)
+        except:
+            self.invalidate(user.discord_id)
+            raise
+        return user
+
+    def invalidate(self, discord_id):
+        self.users.pop(str(discord_id), None)
@@ -6,7 +6,20 @@ class DatabaseMigratable:
         self.conn = conn
 
     @contextmanager
-    def create_resource(self):
+    def create_resource(self, transactional=True):
+        if not transactional:
+            # Statements like CREATE INDEX CONCURRENTLY can't run inside a transaction block
+            self.conn.autocommit = True
+            try:
+                with self.conn.cursor() as cursor:
+                    cursor.execute(
+                        "CREATE TABLE IF NOT EXISTS schema_version(revision_id INT NOT NULL)"
+                    )
+                    yield cursor
+            finally:
+                self.conn.autocommit = False
+            return
+
         # http://initd.org/psycopg/docs/usage.html#with-statement
         with self.conn:  # transaction control, does NOT close the connection
             with self.conn.cursor() as cursor:  # auto resource release of cursor
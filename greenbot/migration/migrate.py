@@ -50,7 +50,9 @@ class Migration:
         for rev in revisions_to_run:
             # create a fresh resource for each individual migration
             # (we want to COMMIT after each successful migration revision)
-            with self.migratable.create_resource() as resource:
+            with self.migratable.create_resource(
+                transactional=rev.transactional
+            ) as resource:
                 log.debug(
                     "migrate %s: running migration %s: %s",
                     self.migratable.describe_resource(),
@@ -74,6 +76,7 @@ class Migration:
             module = importer.find_module(modname).load_module(modname)
             id_in_module = getattr(module, "ID", None)
             name_in_module = getattr(module, "NAME", None)
+            transactional = getattr(module, "TRANSACTIONAL", True)
             up_action = getattr(module, "up", None)
 
             module_name_match = MODULE_NAME_REGEX.search(modname)
@@ -112,7 +115,7 @@ class Migration:
             if any(rev.id == id for rev in revisions):
                 raise ValueError(f"ID {id} was defined twice. Cannot proceed.")
 
-            revision = Revision(id, name, up_action)
+            revision = Revision(id, name, up_action, transactional)
 
             revisions.append(revision)
 
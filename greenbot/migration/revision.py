@@ -1,5 +1,8 @@
 class Revision:
-    def __init__(self, id, name, up_action):
+    def __init__(self, id, name, up_action, transactional=True):
         self.id = id
         self.name = name
         self.up_action = up_action
+        # Revisions with TRANSACTIONAL = False run in autocommit mode,
+        # so they have to be safe to run again if they fail halfway
+        self.transactional = transactional
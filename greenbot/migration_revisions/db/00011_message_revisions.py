@@ -0,0 +1,30 @@
+def up(cursor, bot):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_revision (
+            id SERIAL PRIMARY KEY,
+            message_id TEXT REFERENCES message(message_id) ON DELETE CASCADE,
+            content TEXT NOT NULL,
+            time_edited TIMESTAMPTZ NOT NULL
+        );
+        """
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS message_revision_message_id_idx ON message_revision(message_id);"""
+    )
+    # Move the edits stored in the json content array into their own rows
+    cursor.execute(
+        """
+        INSERT INTO message_revision (message_id, content, time_edited)
+            SELECT message_id, history.content, COALESCE(time_sent, NOW())
+            FROM message, jsonb_array_elements_text(message.content::jsonb) WITH ORDINALITY AS history(content, position)
+            WHERE history.position > 1
+            ORDER BY message_id, history.position;
+        """
+    )
+    cursor.execute(
+        """
+        UPDATE message SET content = jsonb_build_array(content::jsonb->0)::text
+            WHERE jsonb_array_length(content::jsonb) > 1;
+        """
+    )
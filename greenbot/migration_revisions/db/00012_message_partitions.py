@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+import greenbot.utils as utils
+
+
+def up(cursor, bot):
+    cursor.execute("""ALTER TABLE message RENAME TO message_unpartitioned;""")
+    cursor.execute(
+        """ALTER INDEX message_pkey RENAME TO message_unpartitioned_pkey;"""
+    )
+    # message_id alone is no longer unique, so the revisions can't reference it
+    cursor.execute(
+        """ALTER TABLE message_revision DROP CONSTRAINT IF EXISTS message_revision_message_id_fkey;"""
+    )
+
+    cursor.execute(
+        """
+        CREATE TABLE message (
+            message_id TEXT NOT NULL,
+            user_id TEXT REFERENCES "user"(discord_id) ON DELETE CASCADE,
+            channel_id TEXT,
+            content TEXT NOT NULL,
+            time_sent TIMESTAMPTZ NOT NULL,
+            credited BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (message_id, time_sent)
+        ) PARTITION BY RANGE (time_sent);
+        """
+    )
+    cursor.execute("""CREATE TABLE message_default PARTITION OF message DEFAULT;""")
+
+    # Everything before today goes into a single partition, from today on there is one per day
+    today = utils.now().date()
+    cursor.execute(
+        f"""
+        CREATE TABLE message_history PARTITION OF message
+            FOR VALUES FROM (MINVALUE) TO ('{today.isoformat()} 00:00:00+00');
+        """
+    )
+    day = today
+    while day <= today + timedelta(days=7):
+        cursor.execute(
+            f"""
+            CREATE TABLE message_p{day:%Y%m%d} PARTITION OF message
+                FOR VALUES FROM ('{day.isoformat()} 00:00:00+00') TO ('{(day + timedelta(days=1)).isoformat()} 00:00:00+00');
+            """
+        )
+        day += timedelta(days=1)
+
+    cursor.execute(
+        """
+        INSERT INTO message (message_id, user_id, channel_id, content, time_sent, credited)
+            SELECT message_id, user_id, channel_id, content, COALESCE(time_sent, NOW()), COALESCE(credited, FALSE)
+            FROM message_unpartitioned;
+        """
+    )
+    cursor.execute("""DROP TABLE message_unpartitioned;""")
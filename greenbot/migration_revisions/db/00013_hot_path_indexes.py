@@ -0,0 +1,62 @@
+# CREATE INDEX CONCURRENTLY can't run inside a transaction
+TRANSACTIONAL = False
+
+# name: (columns, predicate)
+MESSAGE_INDEXES = {
+    "user_id_time_sent_idx": ("user_id, time_sent", None),
+    "time_sent_user_id_idx": ("time_sent, user_id", None),
+    "uncredited_time_sent_idx": ("time_sent", "credited = FALSE"),
+}
+
+
+def up(cursor, bot):
+    # Concurrent index builds aren't supported on partitioned tables, so the index is
+    # created on the parent only and then built concurrently and attached per partition.
+    # Partitions created afterwards get the index automatically
+    cursor.execute(
+        """
+        SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = 'message';
+        """
+    )
+    partitions = [row[0] for row in cursor.fetchall()]
+
+    for name, (columns, predicate) in MESSAGE_INDEXES.items():
+        where = f"WHERE {predicate}" if predicate else ""
+        cursor.execute(
+            f"""CREATE INDEX IF NOT EXISTS message_{name} ON ONLY message ({columns}) {where};"""
+        )
+        for partition in partitions:
+            # A failed concurrent build leaves an invalid index behind, drop it so it is rebuilt
+            cursor.execute(
+                f"""
+                SELECT indisvalid FROM pg_index
+                    WHERE indexrelid = to_regclass('{partition}_{name}');
+                """
+            )
+            row = cursor.fetchone()
+            if row is not None and not row[0]:
+                cursor.execute(f"""DROP INDEX CONCURRENTLY {partition}_{name};""")
+
+            cursor.execute(
+                f"""CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition}_{name} ON {partition} ({columns}) {where};"""
+            )
+            cursor.execute(
+                f"""
+                SELECT 1 FROM pg_inherits
+                    WHERE inhparent = 'message_{name}'::regclass AND inhrelid = '{partition}_{name}'::regclass;
+                """
+            )
+            if cursor.fetchone() is None:
+                cursor.execute(
+                    f"""ALTER INDEX message_{name} ATTACH PARTITION {partition}_{name};"""
+                )
+
+    cursor.execute(
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS timeouts_user_id_active_idx ON timeouts (user_id) WHERE active = TRUE;"""
+    )
+    cursor.execute(
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS giveaway_entries_user_id_giveaway_id_idx ON giveaway_entries (user_id, giveaway_id);"""
+    )
@@ -0,0 +1,4 @@
+def up(cursor, bot):
+    cursor.execute(
+        """ALTER TABLE banphrase_data ADD COLUMN IF NOT EXISTS last_hit TIMESTAMPTZ DEFAULT NULL;"""
+    )
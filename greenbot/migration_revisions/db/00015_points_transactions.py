@@ -0,0 +1,16 @@
+def up(cursor, bot):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS points_transaction (
+            id BIGSERIAL PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            amount INT NOT NULL,
+            balance INT,
+            reason TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+        """
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS points_transaction_user_id_idx ON points_transaction(user_id);"""
+    )
@@ -1,4 +1,5 @@
 import collections
+import inspect
 import json
 import logging
 import sys
@@ -7,6 +8,9 @@ import regex as re
 import requests
 import discord
 
+from greenbot.exc import TemplateBudgetExceeded
+from greenbot.managers.redis import RedisManager
+
 log = logging.getLogger(__name__)
 
 
@@ -44,25 +48,32 @@ class Function:
     args_sub_regex = re.compile(r"[\"\']((?:\\\"|\\\'|[^\"\'])*)[\"\']")
 
     @staticmethod
-    async def run_functions(_input, args, extra, author, channel, private_message, bot):
-        _input = Substitution.apply_subs(_input, args, extra)[0]
-        for sub_key in Function.function_regex.finditer(_input):
-            func_name = sub_key.group(1)
-            args = sub_key.group(2)
-            array_args = []
-            for arg in Substitution.args_sub_regex.finditer(args):
-                array_args.append(revert_escape_args(arg.group(1)))
-            if func_name not in MappingMethods.func_methods():
-                log.error(f"function {func_name} not found!")
+    async def run_functions(calls, args, extra, author, channel, private_message, bot):
+        """ calls is the list of FunctionCall compiled by Template.compile_functions, returns how many were run """
+        functions_ran = 0
+        if not calls:
+            return functions_ran
+
+        func_methods = MappingMethods.func_methods()
+        for call in calls:
+            if call.name not in func_methods:
+                log.error(f"function {call.name} not found!")
                 continue
 
-            resp, embed = await MappingMethods.func_methods()[func_name](
-                array_args, extra
-            )
+            # Rendered right before the call, so they see what earlier functions changed
+            context = RenderContext(args, extra)
+            try:
+                array_args = [await arg.render_in(context, []) for arg in call.args]
+            except TemplateBudgetExceeded as e:
+                e.functions_ran = functions_ran
+                raise
+            functions_ran += 1
+            resp, embed = await func_methods[call.name](array_args, extra)
             if private_message and (resp is not None or embed is not None):
                 await bot.private_message(user=author, message=resp, embed=embed)
             elif (resp is not None or embed is not None):
                 await bot.say(channel=channel, message=resp, embed=embed)
+        return functions_ran
 
 
 class Substitution:
@@ -74,118 +85,322 @@ class Substitution:
 
     user_args_sub_regex = re.compile(r"(?<!\\)\$\((\d+)(\+?)\)")
 
+
+class TemplateArg:
+    """ $(N) or $(N+), the Nth word of the message or everything from it on """
+
+    def __init__(self, index, rest):
+        self.index = index
+        self.rest = rest
+
+    async def render(self, context, embeds):
+        args = context.args
+        if self.rest:
+            return " ".join(args[self.index :])
+        return args[self.index] if len(args) >= self.index + 1 else ""
+
+
+class TemplateFilter:
+    """ $(name;["arg", ...]:key), every argument is a Template of its own """
+
+    def __init__(self, name, args, key, source):
+        self.name = name
+        self.args = args
+        self.key = key
+        # Rendered as is when there's no filter with this name
+        self.source = source
+
+        # Upper bounds of what rendering this costs, see RenderBudget.check
+        self.depth = max(
+            1 + max((arg.depth for arg in args), default=0), source.depth
+        )
+        self.filter_calls = max(
+            1 + sum(arg.filter_calls for arg in args), source.filter_calls
+        )
+
+    async def render(self, context, embeds):
+        if self.name not in MappingMethods.filters:
+            return await self.source.render_in(context, [])
+
+        context.enter_filter()
+        try:
+            # Embeds of filters nested in the arguments are dropped
+            args = [await arg.render_in(context, []) for arg in self.args]
+        finally:
+            context.depth -= 1
+        resp, embed = await context.run_filter(self.name, args, self.key)
+        if embed is not None:
+            embeds.append(embed)
+        return str(resp) if resp is not None else ""
+
+
+class RenderBudget:
+    """
+    Limits of a single render. Templates are written by moderators and
+    rendered on the shared event loop, so they can't be trusted to be cheap.
+    """
+
+    # Filters nested in filter arguments
+    MAX_DEPTH = 8
+    # Length of the final response, Discord doesn't send longer messages
+    MAX_MESSAGE_LENGTH = 2000
+    # Filter calls, including the ones answered from the memoized results
+    MAX_FILTER_CALLS = 50
+
+    # (command, limit) -> how often rendering the command ran out of budget
+    exceeded = collections.Counter()
+
     @staticmethod
-    def apply_subs(_input, args, extra):
-        count = 0
-        embeds = []
-        for user_sub_key in Substitution.user_args_sub_regex.finditer(_input):
-            needle = user_sub_key.group(0)
-            index = int(user_sub_key.group(1)) - 1
-            additions = user_sub_key.group(2)
-            _input = _input.replace(
-                needle,
-                (
-                    " ".join(args[index:])
-                    if additions
-                    else args[index]
-                    if len(args) >= index + 1
-                    else ""
-                ),
-                1,
+    def check(rendered):
+        """
+        The depth and filter calls only depend on the template, so a Template
+        or FunctionCall can be checked before anything is run
+        """
+        if rendered.depth > RenderBudget.MAX_DEPTH:
+            raise TemplateBudgetExceeded(
+                "depth",
+                f"the response nests filters more than {RenderBudget.MAX_DEPTH} levels deep",
             )
-            count += 1
-
-        for sub_key in Substitution.substitution_regex.finditer(_input):
-            needle = sub_key.group(0)
-            filter_name = sub_key.group(1)
-            args = sub_key.group(2)
-            key = sub_key.group(8)
-            array_args = []
-            for arg in Substitution.args_sub_regex.finditer(args):
-                array_args.append(
-                    revert_escape_args(Substitution.apply_subs(
-                        arg.group(1) if arg.group(1) else "", args, extra
-                    )[0])
-                )
-
-            final_sub = needle
-            if filter_name in MappingMethods.subs_methods():
-                resp, embed = MappingMethods.subs_methods()[filter_name](
-                    args=array_args, key=key, extra=extra
-                )
-                if embed != None:
-                    embeds.append(embed)
-                final_sub = resp
-            _input = _input.replace(
-                needle, str(final_sub) if final_sub is not None else "", 1
+        if rendered.filter_calls > RenderBudget.MAX_FILTER_CALLS:
+            raise TemplateBudgetExceeded(
+                "filter_calls",
+                f"the response uses more than {RenderBudget.MAX_FILTER_CALLS} filters",
             )
-            count += 1
-        if count > 0:
-            _input, embeds_ = Substitution.apply_subs(_input, args, extra)
-            embeds += embeds_
-        return _input, embeds
 
+    @staticmethod
+    def record(command, limit):
+        RenderBudget.exceeded[(command, limit)] += 1
 
-class MappingMethods:
-    bot = None
+    @staticmethod
+    def summary():
+        summary = {}
+        for (command, limit), count in RenderBudget.exceeded.items():
+            summary.setdefault(command, {})[limit] = count
+        return summary
 
     @staticmethod
-    def init(bot):
-        MappingMethods.bot = bot
+    def redis_key(bot_name):
+        return f"{bot_name}:render-budget"
 
     @staticmethod
-    def subs_methods():
-        method_mapping = {}
-        bot = MappingMethods.bot
+    async def publish(bot_name):
         try:
-            method_mapping["role"] = bot.filters.get_role if bot else None
-            method_mapping["_role"] = bot.filters.get_role_value if bot else None
-            method_mapping["member"] = bot.filters.get_member if bot else None
-            method_mapping["currency"] = bot.filters.get_currency if bot else None
-            method_mapping["user"] = bot.filters.get_user if bot else None
-            method_mapping["userinfo"] = bot.filters.get_user_info if bot else None
-            method_mapping["roleinfo"] = bot.filters.get_role_info if bot else None
-            method_mapping["commands"] = bot.filters.get_commands if bot else None
-            method_mapping["commandinfo"] = (
-                bot.filters.get_command_info if bot else None
+            RedisManager.get().set(
+                RenderBudget.redis_key(bot_name), json.dumps(RenderBudget.summary())
+            )
+        except:
+            log.exception("Failed to publish the render budget counters")
+
+
+class RenderContext:
+    """ State of one render, shared with the templates of the filter arguments """
+
+    def __init__(self, args, extra):
+        self.args = args
+        self.extra = extra
+        # Filter results by (name, args, key), every filter runs once per render
+        self.results = {}
+        self.depth = 0
+        self.filter_calls = 0
+
+    def enter_filter(self):
+        self.filter_calls += 1
+        if self.filter_calls > RenderBudget.MAX_FILTER_CALLS:
+            raise TemplateBudgetExceeded(
+                "filter_calls",
+                f"the response uses more than {RenderBudget.MAX_FILTER_CALLS} filters",
             )
-            method_mapping["time"] = bot.filters.get_time_value if bot else None
-            method_mapping["command"] = bot.filters.get_command_value if bot else None
-            method_mapping["author"] = bot.filters.get_author_value if bot else None
-            method_mapping["_channel"] = bot.filters.get_channel_value if bot else None
-            method_mapping["channel"] = bot.filters.get_channel if bot else None
-            method_mapping["emoji"] = bot.filters.get_emoji_url if bot else None
-        except AttributeError:
-            pass
-        return method_mapping
 
-    @staticmethod
-    def func_methods():
-        method_mapping = {}
-        bot = MappingMethods.bot
-        try:
-            method_mapping["kick"] = bot.functions.func_kick_member if bot else None
-            method_mapping["ban"] = bot.functions.func_ban_member if bot else None
-            method_mapping["unban"] = bot.functions.func_unban_member if bot else None
-            method_mapping["addrole"] = (
-                bot.functions.func_add_role_member if bot else None
+        self.depth += 1
+        if self.depth > RenderBudget.MAX_DEPTH:
+            self.depth -= 1
+            raise TemplateBudgetExceeded(
+                "depth",
+                f"the response nests filters more than {RenderBudget.MAX_DEPTH} levels deep",
             )
-            method_mapping["removerole"] = (
-                bot.functions.func_remove_role_member if bot else None
+
+    async def run_filter(self, name, args, key):
+        by_attribute = name in MappingMethods.attribute_filters
+        cache_key = (name, tuple(args), None if by_attribute else key)
+        result = self.results.get(cache_key, None)
+        if result is None:
+            result = MappingMethods.filters[name](
+                args=args, key=None if by_attribute else key, extra=self.extra
             )
-            method_mapping["level"] = bot.functions.func_level if bot else None
-            method_mapping["setpoints"] = (
-                bot.functions.func_set_balance if bot else None
+            if inspect.isawaitable(result):
+                result = await result
+            self.results[cache_key] = result
+
+        resp, embed = result
+        if by_attribute and key and resp is not None:
+            resp = getattr(resp, key)
+        return resp, embed
+
+
+class FunctionCall:
+    """ $(name;["arg", ...]) in the functions of a command """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        # The arguments of a call are rendered together
+        self.depth = max((arg.depth for arg in args), default=0)
+        self.filter_calls = sum(arg.filter_calls for arg in args)
+
+
+class Template:
+    """
+    A response compiled into literals, message argument references and filter calls.
+    Compiling runs the substitution regexes once, rendering just walks the nodes.
+    """
+
+    # Compiled nodes stand in for their source text while the rest is parsed
+    PLACEHOLDER_BASE = 0xF0000
+    placeholder_regex = re.compile("([\U000F0000-\U000FFFFD])")
+
+    def __init__(self, nodes):
+        # Either literal strings or TemplateArg/TemplateFilter
+        self.nodes = nodes
+        filters = [node for node in nodes if isinstance(node, TemplateFilter)]
+        self.depth = max((node.depth for node in filters), default=0)
+        self.filter_calls = sum(node.filter_calls for node in filters)
+
+    async def render(self, args, extra):
+        """ Returns the rendered string and the embeds returned by the filters """
+        embeds = []
+        rendered = await self.render_in(RenderContext(args, extra), embeds)
+        if len(rendered) > RenderBudget.MAX_MESSAGE_LENGTH:
+            raise TemplateBudgetExceeded(
+                "output_length",
+                f"the response is longer than {RenderBudget.MAX_MESSAGE_LENGTH} characters",
             )
-            method_mapping["adjpoints"] = (
-                bot.functions.func_adj_balance if bot else None
+        return rendered, embeds
+
+    async def render_in(self, context, embeds):
+        parts = []
+        for node in self.nodes:
+            parts.append(
+                node if isinstance(node, str) else await node.render(context, embeds)
             )
-            method_mapping["output"] = bot.functions.func_output if bot else None
-            method_mapping["embed"] = bot.functions.func_embed_image if bot else None
-            method_mapping["rename"] = bot.functions.func_rename if bot else None
-        except AttributeError:
-            pass
-        return method_mapping
+        return "".join(parts)
+
+    @staticmethod
+    def compile(source):
+        nodes = []
+        return Template.build(Template.replace_nodes(source, nodes), nodes)
+
+    @staticmethod
+    def compile_functions(source):
+        """ Compiles the functions string of a command into a list of FunctionCall """
+        nodes = []
+        text = Template.replace_nodes(source, nodes)
+        return [
+            FunctionCall(
+                match.group(1),
+                [
+                    Template.build(arg.group(1), nodes)
+                    for arg in Function.args_sub_regex.finditer(match.group(2))
+                ],
+            )
+            for match in Function.function_regex.finditer(text)
+        ]
+
+    @staticmethod
+    def placeholder(node, nodes):
+        nodes.append(node)
+        return chr(Template.PLACEHOLDER_BASE + len(nodes) - 1)
+
+    @staticmethod
+    def replace_nodes(source, nodes):
+        """ Replaces every argument reference and filter call with a placeholder """
+        # Nothing sane uses these code points, drop them so they can't be confused with a placeholder
+        source = Template.placeholder_regex.sub("", source)
+        text = Substitution.user_args_sub_regex.sub(
+            lambda match: Template.placeholder(
+                TemplateArg(int(match.group(1)) - 1, bool(match.group(2))), nodes
+            ),
+            source,
+        )
+        return Template.replace_filters(text, nodes)
+
+    @staticmethod
+    def replace_filters(text, nodes):
+        """
+        Filters are matched until none are left, so a filter nested in a quoted
+        argument is compiled before the filter around it
+        """
+
+        def compile_filter(match):
+            return Template.placeholder(
+                TemplateFilter(
+                    match.group(1),
+                    [
+                        Template.build(Template.replace_filters(arg.group(1), nodes), nodes)
+                        for arg in Substitution.args_sub_regex.finditer(match.group(2))
+                    ],
+                    match.group(8),
+                    Template.build(match.group(0), nodes),
+                ),
+                nodes,
+            )
+
+        count = 1
+        while count > 0:
+            text, count = Substitution.substitution_regex.subn(compile_filter, text)
+        return text
+
+    @staticmethod
+    def build(text, nodes):
+        template_nodes = []
+        for index, part in enumerate(Template.placeholder_regex.split(text)):
+            if index % 2:
+                template_nodes.append(nodes[ord(part) - Template.PLACEHOLDER_BASE])
+            elif part:
+                template_nodes.append(revert_escape_args(part))
+        return Template(template_nodes)
+
+
+class MappingMethods:
+    """
+    Registry of the filters ($(name;[...]:key)) and functions ($(name;[...])) templates can use.
+    Filters and Functions register theirs when they are constructed, modules can register their own.
+    """
+
+    filters = {}
+    # Filters that resolve an object, the key is looked up on the result so
+    # $(user;["x"]:points) and $(user;["x"]:level) share one lookup
+    attribute_filters = set()
+    functions = {}
+
+    @staticmethod
+    def register_filter(name, method, by_attribute=False):
+        """ method(args, key, extra) returns (value, embed), it may be a coroutine function """
+        MappingMethods.filters[name] = method
+        if by_attribute:
+            MappingMethods.attribute_filters.add(name)
+        else:
+            MappingMethods.attribute_filters.discard(name)
+
+    @staticmethod
+    def unregister_filter(name):
+        MappingMethods.filters.pop(name, None)
+        MappingMethods.attribute_filters.discard(name)
+
+    @staticmethod
+    def register_function(name, method):
+        MappingMethods.functions[name] = method
+
+    @staticmethod
+    def unregister_function(name):
+        MappingMethods.functions.pop(name, None)
+
+    @staticmethod
+    def subs_methods():
+        return MappingMethods.filters
+
+    @staticmethod
+    def func_methods():
+        return MappingMethods.functions
 
 
 class BaseAction:
@@ -277,10 +492,14 @@ class MultiAction(BaseAction):
 
         cmd = None
         if message:
-            msg_lower_parts = message.lower().split(" ")
-            command = msg_lower_parts[0]
-            cmd = self.commands.get(command, None)
-            extra_msg = " ".join(message.split(" ")[1:])
+            # Already looked up by the CommandResolver if the command came from a chat message
+            sub_command = args.pop("sub_command", None)
+            if sub_command is not None:
+                command, cmd, extra_msg = sub_command
+            else:
+                command, _, extra_msg = message.partition(" ")
+                command = command.lower()
+                cmd = self.commands.get(command, None)
             if cmd is None and self.fallback:
                 cmd = self.commands.get(self.fallback, None)
                 extra_msg = message
@@ -300,9 +519,6 @@ class MultiAction(BaseAction):
         return None
 
 
-def escape_args(args):
-    return [x.replace("$", "\\$").replace("'", "\\'").replace("\"", "\\\"") for x in args]
-
 def revert_escape_args(resp):
     return resp.replace("\\$", "$").replace("\\'", "'").replace("\\\"", "\"")
 
@@ -312,21 +528,62 @@ class MessageAction(BaseAction):
     def __init__(self, response, bot, functions=""):
         self.response = response
         self.functions = functions
+        # Compiled once here, running the action only renders them
+        self.template = Template.compile(response) if response else None
+        self.function_calls = (
+            Template.compile_functions(functions) if functions else []
+        )
 
-    def get_response(self, bot, extra):
-        MappingMethods.init(bot)
-        if not self.response:
+    async def get_response(self, bot, extra):
+        if self.template is None:
             return None, None
 
-        resp, embeds = Substitution.apply_subs(
-            self.response, escape_args(extra["message"].split(" ")), extra
-        )
-        return revert_escape_args(resp), embeds
+        return await self.template.render(extra["message"].split(" "), extra)
 
     @staticmethod
     def get_extra_data(author, channel, message, args):
         return {"author": author, "channel": channel, "message": message, **args}
 
+    async def run_template(self, bot, author, channel, message, args):
+        """
+        Runs the functions and renders the response.
+        Returns None if the render budget ran out before any function was run,
+        once one was the command counts as run and nothing more is sent.
+        """
+        extra = self.get_extra_data(author, channel, message, args)
+        functions_ran = 0
+        try:
+            for rendered in self.function_calls + ([self.template] if self.template else []):
+                RenderBudget.check(rendered)
+
+            functions_ran = await Function.run_functions(
+                self.function_calls,
+                extra["message"].split(" "),
+                extra,
+                author,
+                channel,
+                args["whisper"],
+                bot,
+            )
+            return await self.get_response(bot, extra)
+        except TemplateBudgetExceeded as e:
+            command = extra.get("command", None)
+            name = command.command if command is not None else extra.get("trigger", None)
+            RenderBudget.record(name, e.limit)
+            log.warning(f"Command {name} ran out of render budget: {e}")
+            # The length of the output depends on the message, so this can happen after
+            # functions with side effects were run already
+            if functions_ran or e.functions_ran:
+                await bot.private_message(
+                    author, f"This command was only partially run, {e}", ignore_escape=True
+                )
+                return None, []
+
+            await bot.private_message(
+                author, f"This command could not be run, {e}", ignore_escape=True
+            )
+            return None
+
     async def run(self, bot, author, channel, message, args):
         raise NotImplementedError("Please implement the run method.")
 
@@ -335,19 +592,11 @@ class ReplyAction(MessageAction):
     subtype = "Reply"
 
     async def run(self, bot, author, channel, message, args):
-        extra = self.get_extra_data(author, channel, message, args)
-        MappingMethods.init(bot)
-        await Function.run_functions(
-            self.functions,
-            escape_args(extra["message"].split(" ")),
-            extra,
-            author,
-            channel,
-            args["whisper"],
-            bot,
-        )
+        rendered = await self.run_template(bot, author, channel, message, args)
+        if rendered is None:
+            return False
 
-        resp, embeds = self.get_response(bot, extra)
+        resp, embeds = rendered
         if not resp and not embeds:
             return True
 
@@ -371,19 +620,11 @@ class PrivateMessageAction(MessageAction):
     subtype = "Private Message"
 
     async def run(self, bot, author, channel, message, args):
-        extra = self.get_extra_data(author, channel, message, args)
-        MappingMethods.init(bot)
-        await Function.run_functions(
-            self.functions,
-            extra["message"].split(" "),
-            extra,
-            author,
-            channel,
-            args["whisper"],
-            bot,
-        )
+        rendered = await self.run_template(bot, author, channel, message, args)
+        if rendered is None:
+            return False
 
-        resp, embeds = self.get_response(bot, extra)
+        resp, embeds = rendered
         if not resp and not embeds:
             return True
 
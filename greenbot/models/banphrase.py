@@ -1,18 +1,27 @@
 import argparse
 import logging
 import re
+import time
 
+import regex
 import sqlalchemy
 from datetime import timedelta
 from sqlalchemy import BOOLEAN, INT, TEXT
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import relationship
+from sqlalchemy_utc import UtcDateTime
 from unidecode import unidecode
 
+from greenbot.managers.adminlog import AdminLogManager
 from greenbot.managers.db import Base
 from greenbot.managers.db import DBManager
+from greenbot.managers.schedule import ScheduleManager
+from greenbot.managers.sock import SocketClientManager
+from greenbot.utils import AhoCorasick
 from greenbot.utils import find
+from greenbot.utils import now
+from greenbot.utils import NormalizedContent
 
 log = logging.getLogger("greenbot")
 
@@ -36,6 +45,17 @@ class Banphrase(Base):
 
     DEFAULT_TIMEOUT_LENGTH = 300
 
+    # How long (in seconds) a regex banphrase may spend on a single message
+    REGEX_TIMEOUT = 0.05
+    # How long (in seconds) a new regex may spend on each of the LINT_INPUTS
+    LINT_TIMEOUT = 0.1
+    # Inputs that make patterns with nested or overlapping quantifiers backtrack catastrophically
+    LINT_INPUTS = [
+        filler * 2000 + end
+        for filler in ["a", "A", "0", " ", ".", "-", "ab", "a ", "aa-"]
+        for end in ["", "!", "\x00"]
+    ]
+
     def __init__(self, **options):
         self.id = None
         self.name = "No name"
@@ -63,7 +83,16 @@ class Banphrase(Base):
 
         self.refresh_operator()
 
+    @staticmethod
+    def _disable(db_session, banphrase_id):
+        db_session.query(Banphrase).filter_by(id=banphrase_id).update(
+            {"enabled": False}, synchronize_session=False
+        )
+
     def format_message(self, message):
+        if isinstance(message, NormalizedContent):
+            return message.get(self.case_sensitive is not False, self.remove_accents)
+
         if self.case_sensitive is False:
             message = message.lower()
         if self.remove_accents:
@@ -82,13 +111,39 @@ class Banphrase(Base):
         self.compiled_regex = None
         if self.operator == "regex":
             try:
-                if self.case_sensitive:
-                    self.compiled_regex = re.compile(self.phrase)
-                else:
-                    self.compiled_regex = re.compile(self.phrase, flags=re.IGNORECASE)
+                self.compiled_regex = Banphrase.compile_regex(
+                    self.phrase, self.case_sensitive
+                )
             except Exception:
                 log.exception(f"Unable to compile regex: {self.phrase}")
 
+    @staticmethod
+    def compile_regex(phrase, case_sensitive):
+        if case_sensitive:
+            return regex.compile(phrase)
+        return regex.compile(phrase, flags=regex.IGNORECASE)
+
+    @staticmethod
+    def lint_regex(phrase, case_sensitive):
+        """
+        Returns why the given pattern can't be used as a banphrase, or None if it's fine.
+        The pattern is run against inputs that are known to make bad patterns backtrack forever
+        """
+        try:
+            compiled_regex = Banphrase.compile_regex(phrase, case_sensitive)
+        except Exception as e:
+            return f"Invalid regex: {e}"
+
+        for lint_input in Banphrase.LINT_INPUTS:
+            if not case_sensitive:
+                lint_input = lint_input.lower()
+            try:
+                compiled_regex.search(lint_input, timeout=Banphrase.LINT_TIMEOUT)
+            except TimeoutError:
+                return f'The regex is too slow on messages like "{lint_input[:20]}..." ({len(lint_input)} characters), check for nested quantifiers like (a+)+'
+
+        return None
+
     def predicate_contains(self, message):
         return self.get_phrase() in self.format_message(message)
 
@@ -105,7 +160,10 @@ class Banphrase(Base):
         if not self.compiled_regex:
             return False
 
-        return self.compiled_regex.search(self.format_message(message))
+        # Raises TimeoutError if the pattern runs over its budget
+        return self.compiled_regex.search(
+            self.format_message(message), timeout=self.REGEX_TIMEOUT
+        )
 
     def match(self, message):
         """
@@ -161,6 +219,7 @@ class BanphraseData(Base):
         INT, ForeignKey("banphrase.id"), primary_key=True, autoincrement=False
     )
     num_uses = Column(INT, nullable=False, default=0)
+    last_hit = Column(UtcDateTime(), nullable=True)
     added_by = Column(
         TEXT, ForeignKey("user.discord_id", ondelete="SET NULL"), nullable=True
     )
@@ -199,15 +258,261 @@ class BanphraseData(Base):
         self.added_by = options.get("added_by", self.added_by)
         self.edited_by = options.get("edited_by", self.edited_by)
 
+    @staticmethod
+    def _add_hits(db_session, hits):
+        """ Adds the given {banphrase_id: (count, last_hit)} to the counters with a single statement """
+        if not hits:
+            return
+
+        values = []
+        params = {}
+        for index, (banphrase_id, (count, last_hit)) in enumerate(hits.items()):
+            values.append(
+                f"(:banphrase_id_{index}, :count_{index}, CAST(:last_hit_{index} AS TIMESTAMPTZ))"
+            )
+            params[f"banphrase_id_{index}"] = banphrase_id
+            params[f"count_{index}"] = count
+            params[f"last_hit_{index}"] = last_hit
+
+        db_session.execute(
+            sqlalchemy.text(
+                "UPDATE banphrase_data SET "
+                "num_uses = banphrase_data.num_uses + hits.count, "
+                "last_hit = GREATEST(banphrase_data.last_hit, hits.last_hit) "
+                f"FROM (VALUES {', '.join(values)}) AS hits(banphrase_id, count, last_hit) "
+                "WHERE banphrase_data.banphrase_id = hits.banphrase_id"
+            ),
+            params,
+        )
+
+
+class BanphraseMatcher:
+    """
+    Matches a message against all the given banphrases at once.
+    The phrases of every (case_sensitive, remove_accents) variant share one Aho-Corasick automaton,
+    the regex banphrases of a variant are only checked one by one if their combined alternation matches.
+    Like before, the matching banphrase with the longest timeout wins, ties go to the first one in the list.
+
+    Single banphrases can be changed with upsert and remove without rebuilding the matcher,
+    the compiled entries of changed banphrases are ignored and their new version is matched the slow way
+    until the matcher is built again
+    """
+
+    PLAIN_OPERATORS = ("contains", "startswith", "endswith", "exact")
+
+    # How long (in seconds) all the regex banphrases together may spend on a single message
+    REGEX_BUDGET = 0.15
+
+    # Backreferences change meaning once the patterns are combined
+    BACKREFERENCE_REGEX = re.compile(r"\\\d|\(\?P=")
+
+    def __init__(self, banphrases):
+        variants = {}
+        # Banphrases the matcher can't handle itself, they are matched the slow way
+        self.fallback = []
+        # banphrase_id: position of the banphrase, used to break ties
+        self.positions = {}
+        # IDs of the banphrases whose compiled entries are out of date
+        self.stale = set()
+        # banphrase_id: (key, banphrase) of banphrases changed since the matcher was built
+        self.changed = {}
+
+        for index, banphrase in enumerate(banphrases):
+            self.positions[banphrase.id] = index
+            if banphrase.enabled is False:
+                continue
+
+            key = (-banphrase.length, index)
+            variant = variants.setdefault(
+                (bool(banphrase.case_sensitive), bool(banphrase.remove_accents)),
+                {"phrases": [], "combinable": [], "uncombinable": []},
+            )
+            if banphrase.operator == "regex":
+                if not banphrase.compiled_regex:
+                    continue
+
+                if self.BACKREFERENCE_REGEX.search(banphrase.phrase):
+                    variant["uncombinable"].append((key, banphrase))
+                else:
+                    variant["combinable"].append((key, banphrase))
+            elif banphrase.operator in self.PLAIN_OPERATORS and banphrase.phrase:
+                variant["phrases"].append((banphrase.get_phrase(), (key, banphrase)))
+            else:
+                self.fallback.append((key, banphrase))
+
+        self.variants = []
+        for (case_sensitive, remove_accents), variant in variants.items():
+            combined_regex = None
+            if variant["combinable"]:
+                try:
+                    combined_regex = Banphrase.compile_regex(
+                        "|".join(
+                            f"(?:{banphrase.phrase})"
+                            for _, banphrase in variant["combinable"]
+                        ),
+                        case_sensitive,
+                    )
+                except Exception:
+                    # e.g. inline flags or duplicate group names, check them one by one instead
+                    variant["uncombinable"] += variant["combinable"]
+                    variant["combinable"] = []
+
+            self.variants.append(
+                (
+                    case_sensitive,
+                    remove_accents,
+                    AhoCorasick(variant["phrases"]),
+                    combined_regex,
+                    sorted(variant["combinable"], key=lambda entry: entry[0]),
+                    sorted(variant["uncombinable"], key=lambda entry: entry[0]),
+                )
+            )
+        self.fallback.sort(key=lambda entry: entry[0])
+
+    def upsert(self, banphrase):
+        """ Matches the current version of the banphrase from now on """
+        self.stale.add(banphrase.id)
+        self.changed.pop(banphrase.id, None)
+        if banphrase.enabled is False:
+            return
+
+        position = self.positions.setdefault(banphrase.id, len(self.positions))
+        self.changed[banphrase.id] = ((-banphrase.length, position), banphrase)
+
+    def remove(self, banphrase_id):
+        self.stale.add(banphrase_id)
+        self.changed.pop(banphrase_id, None)
+
+    @staticmethod
+    def regex_timeout(deadline):
+        """ The time a regex may still take, None once the budget of the message is used up """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return min(Banphrase.REGEX_TIMEOUT, remaining)
+
+    def match_regexes(self, regexes, message, best, timed_out, deadline):
+        for key, banphrase in regexes:
+            if best is not None and best[0] <= key:
+                break
+
+            if banphrase.id in self.stale:
+                continue
+
+            timeout = self.regex_timeout(deadline)
+            if timeout is None:
+                log.debug("Regex banphrase budget used up, skipping the rest")
+                break
+
+            try:
+                if banphrase.compiled_regex.search(message, timeout=timeout):
+                    return key, banphrase
+            except TimeoutError:
+                # Only a banphrase that had its full time budget is to blame
+                if timeout >= Banphrase.REGEX_TIMEOUT:
+                    timed_out.append(banphrase)
+        return best
+
+    def match(self, content, timed_out):
+        """
+        content is the NormalizedContent of the message.
+        Regex banphrases that ran over their time budget are added to timed_out
+        """
+        best = None
+        deadline = time.monotonic() + self.REGEX_BUDGET
+        for (
+            case_sensitive,
+            remove_accents,
+            automaton,
+            combined_regex,
+            combinable,
+            uncombinable,
+        ) in self.variants:
+            formatted_message = content.get(case_sensitive, remove_accents)
+            end_of_message = len(formatted_message)
+
+            for start, end, (key, banphrase) in automaton.search(formatted_message):
+                if best is not None and best[0] <= key:
+                    continue
+
+                if banphrase.id in self.stale:
+                    continue
+
+                operator = banphrase.operator
+                if (
+                    operator == "contains"
+                    or (operator == "startswith" and start == 0)
+                    or (operator == "endswith" and end == end_of_message)
+                    or (operator == "exact" and start == 0 and end == end_of_message)
+                ):
+                    best = key, banphrase
+
+            timeout = self.regex_timeout(deadline)
+            if combined_regex is not None and timeout is not None:
+                try:
+                    combined_match = combined_regex.search(
+                        formatted_message, timeout=timeout
+                    )
+                except TimeoutError:
+                    # Find out which of the patterns is the slow one, as far as the budget allows
+                    combined_match = True
+                if combined_match:
+                    best = self.match_regexes(
+                        combinable, formatted_message, best, timed_out, deadline
+                    )
+            best = self.match_regexes(
+                uncombinable, formatted_message, best, timed_out, deadline
+            )
+
+        for key, banphrase in self.fallback:
+            if best is not None and best[0] <= key:
+                break
+
+            if banphrase.id not in self.stale and banphrase.match(content):
+                best = key, banphrase
+
+        for key, banphrase in self.changed.values():
+            if best is not None and best[0] <= key:
+                continue
+
+            if banphrase.operator == "regex" and self.regex_timeout(deadline) is None:
+                continue
+
+            try:
+                if banphrase.match(content):
+                    best = key, banphrase
+            except TimeoutError:
+                timed_out.append(banphrase)
+
+        return best[1] if best else False
+
 
 class BanphraseManager:
+    # How often (in seconds) the hit counters are written to the database
+    HIT_FLUSH_INTERVAL = 30
+    # The matcher is rebuilt this long (in seconds) after a change, so a burst of changes causes one rebuild
+    REBUILD_DELAY = 2
+    # A regex banphrase is disabled once it ran over its time budget this many times
+    QUARANTINE_TIMEOUTS = 5
+    # within this many seconds
+    QUARANTINE_WINDOW = 10 * 60
+
     def __init__(self, bot):
         self.bot = bot
-        self.banphrases = []
-        self.enabled_banphrases = []
+        # banphrase_id: banphrase
+        self.banphrases = {}
+        self.matcher = BanphraseMatcher([])
+        self.rebuild_job = None
         self.db_session = DBManager.create_session(expire_on_commit=False)
+        # banphrase_id: (hits since the last flush, time of the last hit)
+        self.pending_hits = {}
+        # banphrase_id: (timeouts within the window, time of the first one)
+        self.regex_timeouts = {}
 
         if self.bot:
+            self.hit_flush_job = ScheduleManager.execute_every(
+                self.HIT_FLUSH_INTERVAL, self.flush_hits
+            )
             self.bot.socket_manager.add_handler(
                 "banphrase.update", self.on_banphrase_update
             )
@@ -215,6 +520,12 @@ class BanphraseManager:
                 "banphrase.remove", self.on_banphrase_remove
             )
 
+    @property
+    def enabled_banphrases(self):
+        return [
+            banphrase for banphrase in self.banphrases.values() if banphrase.enabled
+        ]
+
     def on_banphrase_update(self, data):
         try:
             banphrase_id = int(data["id"])
@@ -222,9 +533,7 @@ class BanphraseManager:
             log.warning("No banphrase ID found in on_banphrase_update")
             return False
 
-        updated_banphrase = find(
-            lambda banphrase: banphrase.id == banphrase_id, self.banphrases
-        )
+        updated_banphrase = self.banphrases.get(banphrase_id, None)
         if updated_banphrase:
             with DBManager.create_session_scope(expire_on_commit=False) as db_session:
                 db_session.add(updated_banphrase)
@@ -240,17 +549,9 @@ class BanphraseManager:
                     self.db_session.add(updated_banphrase.data)
 
         if updated_banphrase:
-            if updated_banphrase not in self.banphrases:
-                self.banphrases.append(updated_banphrase)
-            if (
-                updated_banphrase.enabled is True
-                and updated_banphrase not in self.enabled_banphrases
-            ):
-                self.enabled_banphrases.append(updated_banphrase)
-
-        for banphrase in self.enabled_banphrases:
-            if banphrase.enabled is False:
-                self.enabled_banphrases.remove(banphrase)
+            self.banphrases[banphrase_id] = updated_banphrase
+            self.matcher.upsert(updated_banphrase)
+            self.schedule_rebuild()
 
     def on_banphrase_remove(self, data):
         try:
@@ -259,33 +560,45 @@ class BanphraseManager:
             log.warning("No banphrase ID found in on_banphrase_remove")
             return False
 
-        removed_banphrase = find(
-            lambda banphrase: banphrase.id == banphrase_id, self.banphrases
-        )
+        removed_banphrase = self.banphrases.pop(banphrase_id, None)
         if removed_banphrase:
             if removed_banphrase.data and removed_banphrase.data in self.db_session:
                 self.db_session.expunge(removed_banphrase.data)
 
-            if removed_banphrase in self.enabled_banphrases:
-                self.enabled_banphrases.remove(removed_banphrase)
+            self.matcher.remove(banphrase_id)
+            self.schedule_rebuild()
+
+    def rebuild_matcher(self):
+        self.matcher = BanphraseMatcher(list(self.banphrases.values()))
 
-            if removed_banphrase in self.banphrases:
-                self.banphrases.remove(removed_banphrase)
+    def schedule_rebuild(self):
+        """ Rebuilds the matcher a bit later, until then changed banphrases are matched the slow way """
+        if not self.bot:
+            self.rebuild_matcher()
+            return
+
+        if self.rebuild_job is None:
+            self.rebuild_job = ScheduleManager.execute_delayed(
+                self.REBUILD_DELAY, self.delayed_rebuild
+            )
+
+    async def delayed_rebuild(self):
+        self.rebuild_job = None
+        self.rebuild_matcher()
 
     def load(self):
-        self.banphrases = self.db_session.query(Banphrase).all()
-        for banphrase in self.banphrases:
+        self.banphrases = {}
+        for banphrase in self.db_session.query(Banphrase).all():
             self.db_session.expunge(banphrase)
-        self.enabled_banphrases = [
-            banphrase for banphrase in self.banphrases if banphrase.enabled is True
-        ]
+            self.banphrases[banphrase.id] = banphrase
+        self.rebuild_matcher()
         return self
 
     def commit(self):
         self.db_session.commit()
 
     def create_banphrase(self, phrase, **options):
-        for banphrase in self.banphrases:
+        for banphrase in self.banphrases.values():
             if banphrase.phrase == phrase:
                 return banphrase, False
 
@@ -299,15 +612,16 @@ class BanphraseManager:
         self.commit()
         self.db_session.expunge(banphrase)
 
-        self.banphrases.append(banphrase)
-        self.enabled_banphrases.append(banphrase)
+        self.banphrases[banphrase.id] = banphrase
+        self.matcher.upsert(banphrase)
+        self.schedule_rebuild()
 
         return banphrase, True
 
     def remove_banphrase(self, banphrase):
-        self.banphrases.remove(banphrase)
-        if banphrase in self.enabled_banphrases:
-            self.enabled_banphrases.remove(banphrase)
+        self.banphrases.pop(banphrase.id, None)
+        self.matcher.remove(banphrase.id)
+        self.schedule_rebuild()
 
         self.db_session.expunge(banphrase.data)
         self.db_session.delete(banphrase)
@@ -320,8 +634,7 @@ class BanphraseManager:
         what sort of punishment a user deserves.
         """
 
-        if banphrase.data is not None:
-            banphrase.data.num_uses += 1
+        self.record_hit(banphrase)
 
         if banphrase.length == 0:
             return
@@ -331,29 +644,104 @@ class BanphraseManager:
         # Finally, time out the user for whatever timeout length was required.
         await self.bot.timeout(member=user, duration=banphrase.length, reason=reason)
 
+    def record_hit(self, banphrase):
+        count, _ = self.pending_hits.get(banphrase.id, (0, None))
+        self.pending_hits[banphrase.id] = (count + 1, now())
+
+    def take_hits(self):
+        pending_hits = self.pending_hits
+        self.pending_hits = {}
+        return pending_hits
+
+    def requeue_hits(self, pending_hits):
+        log.exception(f"Failed to write the hits of {len(pending_hits)} banphrases, requeueing them")
+        for banphrase_id, (count, last_hit) in self.pending_hits.items():
+            pending_count, _ = pending_hits.get(banphrase_id, (0, None))
+            pending_hits[banphrase_id] = (pending_count + count, last_hit)
+        self.pending_hits = pending_hits
+
+    async def flush_hits(self):
+        if not self.pending_hits:
+            return
+
+        pending_hits = self.take_hits()
+        try:
+            await DBManager.run(BanphraseData._add_hits, pending_hits)
+        except:
+            self.requeue_hits(pending_hits)
+
+    def flush_hits_now(self):
+        """ Blocking flush, used when the event loop is going away """
+        if not self.pending_hits:
+            return
+
+        pending_hits = self.take_hits()
+        try:
+            with DBManager.create_session_scope() as db_session:
+                BanphraseData._add_hits(db_session, pending_hits)
+        except:
+            self.requeue_hits(pending_hits)
+
     def check_message(self, message):
-        matched_banphrase = None
-        for banphrase in self.enabled_banphrases:
-            if banphrase.match(message):
-                if not matched_banphrase:
-                    matched_banphrase = banphrase
-                    continue
+        """ message is either the content string or its NormalizedContent """
+        if not isinstance(message, NormalizedContent):
+            message = NormalizedContent(message)
 
-                if banphrase.greater_than(matched_banphrase):
-                    matched_banphrase = banphrase
-                    continue
+        timed_out = []
+        matched_banphrase = self.matcher.match(message, timed_out)
+        # Only the bot disables banphrases, e.g. a test message from the web API must not
+        if self.bot:
+            for banphrase in timed_out:
+                self.record_timeout(banphrase)
+        return matched_banphrase
+
+    def record_timeout(self, banphrase):
+        """ Quarantines the regex banphrase once it timed out repeatedly, a single slow run may just be load """
+        timeouts, first_timeout = self.regex_timeouts.get(banphrase.id, (0, None))
+        if first_timeout is None or now() - first_timeout > timedelta(
+            seconds=self.QUARANTINE_WINDOW
+        ):
+            timeouts, first_timeout = 0, now()
+
+        timeouts += 1
+        log.warning(
+            f"Banphrase {banphrase.id} ({banphrase.phrase}) took more than {Banphrase.REGEX_TIMEOUT}s ({timeouts}/{self.QUARANTINE_TIMEOUTS})"
+        )
+        if timeouts < self.QUARANTINE_TIMEOUTS:
+            self.regex_timeouts[banphrase.id] = (timeouts, first_timeout)
+            return
+
+        self.regex_timeouts.pop(banphrase.id, None)
+        self.quarantine(banphrase)
+
+    def quarantine(self, banphrase):
+        """ Disables a regex banphrase that keeps running over its time budget so it can't block the bot again """
+        log.warning(f"Disabling banphrase {banphrase.id} ({banphrase.phrase})")
+        banphrase.enabled = False
+        self.matcher.remove(banphrase.id)
+        self.schedule_rebuild()
+        self.bot.private_loop.create_task(self.store_quarantine(banphrase))
+
+    async def store_quarantine(self, banphrase):
+        try:
+            await DBManager.run(Banphrase._disable, banphrase.id)
+        except:
+            log.exception(f"Failed to store the quarantine of banphrase {banphrase.id}")
+            return
 
-        return matched_banphrase or False
+        AdminLogManager.post(
+            "Banphrase quarantined", None, banphrase.id, banphrase.phrase
+        )
+        SocketClientManager.send("banphrase.update", {"id": banphrase.id})
 
     def find_match(self, message, banphrase_id=None):
         match = None
         if banphrase_id is not None:
-            match = find(
-                lambda banphrase: banphrase.id == banphrase_id, self.banphrases
-            )
+            match = self.banphrases.get(banphrase_id, None)
         if match is None:
             match = find(
-                lambda banphrase: banphrase.exact_match(message), self.banphrases
+                lambda banphrase: banphrase.exact_match(message),
+                self.banphrases.values(),
             )
         return match
 
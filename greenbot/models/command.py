@@ -3,8 +3,10 @@ import json
 import logging
 import re
 
+from collections import namedtuple
 from sqlalchemy import INT, BOOLEAN, TEXT
 from sqlalchemy import Column
+from sqlalchemy import text
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import reconstructor
 from sqlalchemy.orm import relationship
@@ -12,16 +14,17 @@ from sqlalchemy.orm import relationship
 from sqlalchemy_utc import UtcDateTime
 
 import greenbot.utils
-from greenbot.exc import FailedCommand
-from greenbot.managers.db import DBManager, Base
+from greenbot.managers.db import Base
 from greenbot.managers.schedule import ScheduleManager
 from greenbot.models.action import ActionParser
 from greenbot.models.action import RawFuncAction
 from greenbot.models.action import Substitution
-from greenbot.models.user import User
 
 log = logging.getLogger(__name__)
 
+# What Command.run checks before anything else, channels is a frozenset of channel IDs (empty means any channel)
+CommandEligibility = namedtuple("CommandEligibility", ["level", "whisper", "channels"])
+
 
 def parse_command_for_web(alias, command, list):
     import markdown
@@ -142,6 +145,33 @@ class CommandData(Base):
     def last_date_used(self, value):
         self._last_date_used = value
 
+    @staticmethod
+    def _add_uses(db_session, uses):
+        """ Adds the given {command_id: (count, last_used)} to the counters with a single statement """
+        if not uses:
+            return
+
+        values = []
+        params = {}
+        for index, (command_id, (count, last_used)) in enumerate(uses.items()):
+            values.append(
+                f"(:command_id_{index}, :count_{index}, CAST(:last_used_{index} AS TIMESTAMPTZ))"
+            )
+            params[f"command_id_{index}"] = command_id
+            params[f"count_{index}"] = count
+            params[f"last_used_{index}"] = last_used
+
+        db_session.execute(
+            text(
+                "UPDATE command_data SET "
+                "num_uses = command_data.num_uses + uses.count, "
+                "last_date_used = GREATEST(command_data.last_date_used, uses.last_used) "
+                f"FROM (VALUES {', '.join(values)}) AS uses(command_id, count, last_used) "
+                "WHERE command_data.command_id = uses.command_id"
+            ),
+            params,
+        )
+
     def jsonify(self):
         return {
             "num_uses": self.num_uses,
@@ -226,6 +256,9 @@ class Command(Base):
 
     BYPASS_DELAY_LEVEL = 1500
 
+    # Stable name of a command without a database id in the cooldown store, see CommandManager
+    cooldown_key = None
+
     DEFAULT_CD_ALL = 5
     DEFAULT_CD_USER = 15
     DEFAULT_LEVEL = 100
@@ -250,9 +283,6 @@ class Command(Base):
         self._group = None
         self.channels = "[]"
 
-        self.last_run = 0
-        self.last_run_by_user = {}
-
         self.data = None
         self.run_in_thread = False
         self.notify_on_error = False
@@ -289,6 +319,14 @@ class Command(Base):
         self.examples = options.get("examples", self.examples)
         self.run_in_thread = options.get("run_in_thread", self.run_in_thread)
         self.notify_on_error = options.get("notify_on_error", self.notify_on_error)
+        self.refresh_eligibility()
+
+    def refresh_eligibility(self):
+        self.eligibility = CommandEligibility(
+            self.level,
+            self.can_execute_with_whisper is not False,
+            frozenset(json.loads(self.channels or "[]")),
+        )
 
     def __str__(self):
         return f"Command(!{self.command})"
@@ -311,8 +349,6 @@ class Command(Base):
 
     @reconstructor
     def init_on_load(self):
-        self.last_run = 0
-        self.last_run_by_user = {}
         self.extra_args = {"command": self}
         self.action = ActionParser.parse(self.action_json)
         self.run_in_thread = False
@@ -323,6 +359,7 @@ class Command(Base):
                 log.exception(
                     f"Unhandled exception caught while loading Command extra arguments ({self.extra_extra_args})"
                 )
+        self.refresh_eligibility()
 
     @classmethod
     def from_json(cls, json_object):
@@ -330,6 +367,7 @@ class Command(Base):
         if "level" in json_object:
             cmd.level = json_object["level"]
         cmd.action = ActionParser.parse(data=json_object["action"])
+        cmd.refresh_eligibility()
         return cmd
 
     @classmethod
@@ -360,6 +398,7 @@ class Command(Base):
             cmd.action = RawFuncAction(getattr(bot, method_name))
         except:
             pass
+        cmd.refresh_eligibility()
         return cmd
 
     @classmethod
@@ -375,6 +414,7 @@ class Command(Base):
     def load_args(self, level, action):
         self.level = level
         self.action = action
+        self.refresh_eligibility()
 
     def is_enabled(self):
         return self.enabled == 1 and self.action is not None
@@ -384,21 +424,377 @@ class Command(Base):
             log.warning("This command is not available.")
             return False
 
-        if args["user_level"] < self.level:
+        eligibility = self.eligibility
+        if args["user_level"] < eligibility.level:
             # User does not have a high enough power level to run this command
             return False
 
-        if args["whisper"] and self.can_execute_with_whisper is False:
+        if args["whisper"] and not eligibility.whisper:
             # This user cannot execute the command through a whisper
             return False
 
+        if (
+            channel
+            and eligibility.channels
+            and str(channel.id) not in eligibility.channels
+        ):
+            return False
+
         cd_modifier = 0.2 if args["user_level"] >= 500 else 1.0
-        load_channels = json.loads(self.channels)
-        if channel and str(channel.id) not in load_channels and len(load_channels) > 0:
+
+        cur_time = greenbot.utils.now().timestamp()
+        claimed, last_run, last_run_by_user = bot.cooldown_manager.claim(
+            self,
+            author.id,
+            cur_time,
+            cd_modifier,
+            force=args["user_level"] >= Command.BYPASS_DELAY_LEVEL,
+        )
+        if not claimed:
+            time_since_last_run = (cur_time - last_run) / cd_modifier
+            if time_since_last_run < self.delay_all:
+                await bot.private_message(user=author, message=f"The command **{self.command}** was executed too recently please try again in {greenbot.utils.seconds_to_resp(int(self.delay_all-time_since_last_run))}", ignore_escape=True)
+                return False
+
+            time_since_last_run_user = (cur_time - last_run_by_user) / cd_modifier
+            await bot.private_message(user=author, message=f"You executed the command **{self.command}** too recently please try again in {greenbot.utils.seconds_to_resp(int(self.delay_user-time_since_last_run_user))}", ignore_escape=True)
+            return False
+
+        user = await bot.user_manager.fetch(author.id, str(author))
+        if self.cost > 0 and not user.can_afford(self.cost) and args["user_level"] < Command.BYPASS_DELAY_LEVEL:
+            # User does not have enough points to use the command
+            bot.cooldown_manager.release(self, author.id, cur_time)
+            await bot.private_message(user=author, message=f"You need {self.cost} points to execute that command", ignore_escape=True)
+            return False
+
+        args.update(self.extra_args)
+        if self.run_in_thread:
+            log.debug(f"Running {self} in a thread")
+            await ScheduleManager.execute_now(
+                self.run_action, args=[bot, author, channel, message, args, cur_time]
+            )
+        else:
+            await self.run_action(bot, author, channel, message, args, cur_time)
+
+        return True
+
+    async def run_action(self, bot, author, channel, message, args, cur_time):
+        """ cur_time is when the cooldowns of this run were claimed, they are released again if the action fails """
+        cost = self.cost if args["user_level"] < Command.BYPASS_DELAY_LEVEL else 0
+        if cost <= 0:
+            # Nothing to spend, so there's no need to touch the user
+            try:
+                ret = await self.action.run(bot, author, channel, message, args)
+            except:
+                bot.cooldown_manager.release(self, author.id, cur_time)
+                raise
+            self.finish_run(bot, author, cur_time, ret)
+            return
+
+        # The spend is a single conditional UPDATE, so two commands racing for
+        # the same points can't both succeed
+        reason = f"command:{self.command}"
+        if await bot.points_manager.spend(author.id, cost, reason) is None:
+            bot.cooldown_manager.release(self, author.id, cur_time)
+            await bot.private_message(user=author, message=f"You need {cost} points to execute that command", ignore_escape=True)
+            return
+
+        try:
+            ret = await self.action.run(bot, author, channel, message, args)
+        except:
+            bot.cooldown_manager.release(self, author.id, cur_time)
+            await bot.points_manager.refund(author.id, cost, f"{reason}:refund")
+            raise
+
+        if not ret or ret == "return currency":
+            await bot.points_manager.refund(author.id, cost, f"{reason}:refund")
+
+        self.finish_run(bot, author, cur_time, ret)
+
+    def finish_run(self, bot, author, cur_time, ret):
+        # Only increment num_uses and keep the cooldowns if the action succeded
+        if not ret:
+            bot.cooldown_manager.release(self, author.id, cur_time)
+            return
+
+        if self.data is not None:
+            bot.commands.record_use(self)
+
+    def jsonify(self):
+        return {
+            "num_uses": self.num_uses,
+            "added_by": self.added_by,
+            "edited_by": self.edited_by,
+            "last_date_used": self.last_date_used.isoformat()
+            if self.last_date_used
+            else None,
+        }
+
+
+class CommandExample(Base):
+    __tablename__ = "command_example"
+
+    id = Column(INT, primary_key=True)
+    command_id = Column(
+        INT, ForeignKey("command.id", ondelete="CASCADE"), nullable=False
+    )
+    title = Column(TEXT, nullable=False)
+    chat = Column(TEXT, nullable=False)
+    description = Column(TEXT, nullable=False)
+
+    def __init__(self, command_id, title, chat="", description=""):
+        self.id = None
+        self.command_id = command_id
+        self.title = title
+        self.chat = chat
+        self.description = description
+        self.chat_messages = []
+
+    @reconstructor
+    def init_on_load(self):
+        self.parse()
+
+    def add_chat_message(self, type, message, user_from, user_to=None):
+        chat_message = {
+            "source": {"type": type, "from": user_from, "to": user_to},
+            "message": message,
+        }
+        self.chat_messages.append(chat_message)
+
+    def parse(self):
+        self.chat_messages = []
+        for line in self.chat.split("\n"):
+            users, message = line.split(":", 1)
+            if ">" in users:
+                user_from, user_to = users.split(">", 1)
+                self.add_chat_message("whisper", message, user_from, user_to=user_to)
+            else:
+                self.add_chat_message("say", message, users)
+        return self
+
+    def jsonify(self):
+        return {
+            "id": self.id,
+            "command_id": self.command_id,
+            "title": self.title,
+            "description": self.description,
+            "messages": self.chat_messages,
+        }
+
+
+class Command(Base):
+    __tablename__ = "command"
+
+    id = Column(INT, primary_key=True)
+    level = Column(INT, nullable=False, default=100)
+    action_json = Column("action", TEXT, nullable=False)
+    extra_extra_args = Column("extra_args", TEXT)
+    _command = Column("command", TEXT, nullable=False)
+    _group = Column("command_group", TEXT, nullable=True)
+    description = Column(TEXT, nullable=True)
+    delay_all = Column(INT, nullable=False, default=5)
+    delay_user = Column(INT, nullable=False, default=15)
+    enabled = Column(BOOLEAN, nullable=False, default=True)
+    cost = Column(INT, nullable=False, default=0)
+    can_execute_with_whisper = Column(BOOLEAN)
+    long_description = ""
+    channels = Column(TEXT, nullable=False, default="[]")
+    data = relationship("CommandData", uselist=False, cascade="", lazy="joined")
+    examples = relationship("CommandExample", uselist=True, cascade="", lazy="noload")
+
+    BYPASS_DELAY_LEVEL = 1500
+
+    # Stable name of a command without a database id in the cooldown store, see CommandManager
+    cooldown_key = None
+
+    DEFAULT_CD_ALL = 5
+    DEFAULT_CD_USER = 15
+    DEFAULT_LEVEL = 100
+
+    notify_on_error = False
+
+    def __init__(self, **options):
+        self.id = options.get("id", None)
+
+        self.level = Command.DEFAULT_LEVEL
+        self.action = None
+        self.extra_args = {"command": self}
+        self.delay_all = Command.DEFAULT_CD_ALL
+        self.delay_user = Command.DEFAULT_CD_USER
+        self.description = None
+        self.enabled = True
+        self.type = "?"  # XXX: What is this?
+        self.cost = 0
+        self.can_execute_with_whisper = False
+        self.run_through_banphrases = False
+        self._command = None
+        self._group = None
+        self.channels = "[]"
+
+        self.data = None
+        self.run_in_thread = False
+        self.notify_on_error = False
+
+        self.set(**options)
+
+    def set(self, **options):
+        self.level = options.get("level", self.level)
+        if "action" in options:
+            self.action_json = json.dumps(options["action"])
+            self.action = ActionParser.parse(self.action_json)
+        if "extra_args" in options:
+            self.extra_args = {"command": self}
+            self.extra_args.update(options["extra_args"])
+            self.extra_extra_args = json.dumps(options["extra_args"])
+        self._command = options.get("command", self._command)
+        self._group = options.get("group", self._group)
+        self.description = options.get("description", self.description)
+        self.delay_all = options.get("delay_all", self.delay_all)
+        if self.delay_all < 0:
+            self.delay_all = 0
+        self.delay_user = options.get("delay_user", self.delay_user)
+        if self.delay_user < 0:
+            self.delay_user = 0
+        self.enabled = options.get("enabled", self.enabled)
+        self.cost = int(self.cost)
+        self.cost = options.get("cost", self.cost)
+        self.channels = options.get("channels", self.channels)
+        if self.cost < 0:
+            self.cost = 0
+        self.can_execute_with_whisper = options.get(
+            "can_execute_with_whisper", self.can_execute_with_whisper
+        )
+        self.examples = options.get("examples", self.examples)
+        self.run_in_thread = options.get("run_in_thread", self.run_in_thread)
+        self.notify_on_error = options.get("notify_on_error", self.notify_on_error)
+        self.refresh_eligibility()
+
+    def refresh_eligibility(self):
+        self.eligibility = CommandEligibility(
+            self.level,
+            self.can_execute_with_whisper is not False,
+            frozenset(json.loads(self.channels or "[]")),
+        )
+
+    def __str__(self):
+        return f"Command(!{self.command})"
+
+    @property
+    def aliases(self):
+        return [f"{self.group}{x}" for x in self._command.split("|")]
+
+    @property
+    def command(self):
+        return f"{self.group}{self._command}"
+
+    @property
+    def group(self):
+        return f"{self._group} " if self._group else ""
+
+    @property
+    def channels_web(self):
+        return " ".join(json.loads(self.channels))
+
+    @reconstructor
+    def init_on_load(self):
+        self.extra_args = {"command": self}
+        self.action = ActionParser.parse(self.action_json)
+        self.run_in_thread = False
+        if self.extra_extra_args:
+            try:
+                self.extra_args.update(json.loads(self.extra_extra_args))
+            except:
+                log.exception(
+                    f"Unhandled exception caught while loading Command extra arguments ({self.extra_extra_args})"
+                )
+        self.refresh_eligibility()
+
+    @classmethod
+    def from_json(cls, json_object):
+        cmd = cls()
+        if "level" in json_object:
+            cmd.level = json_object["level"]
+        cmd.action = ActionParser.parse(data=json_object["action"])
+        cmd.refresh_eligibility()
+        return cmd
+
+    @classmethod
+    def dispatch_command(cls, cb, **options):
+        cmd = cls(**options)
+        cmd.action = ActionParser.parse('{"type": "func", "cb": "' + cb + '"}')
+        return cmd
+
+    @classmethod
+    def raw_command(cls, cb, **options):
+        cmd = cls(**options)
+        try:
+            cmd.action = RawFuncAction(cb)
+        except:
+            log.exception(
+                "Uncaught exception in Command.raw_command. catch the following exception manually!"
+            )
+            cmd.enabled = False
+        return cmd
+
+    @classmethod
+    def greenbot_command(cls, bot, method_name, level=1000, **options):
+        cmd = cls(**options)
+        cmd.level = level
+        cmd.description = options.get("description", None)
+        cmd.can_execute_with_whisper = True
+        try:
+            cmd.action = RawFuncAction(getattr(bot, method_name))
+        except:
+            pass
+        cmd.refresh_eligibility()
+        return cmd
+
+    @classmethod
+    def multiaction_command(cls, default=None, fallback=None, **options):
+        from greenbot.models.action import MultiAction
+
+        cmd = cls(**options)
+        cmd.action = MultiAction.ready_built(
+            options.get("commands"), default=default, fallback=fallback
+        )
+        return cmd
+
+    def load_args(self, level, action):
+        self.level = level
+        self.action = action
+        self.refresh_eligibility()
+
+    def is_enabled(self):
+        return self.enabled == 1 and self.action is not None
+
+    async def run(self, bot, author, channel, message, args):
+        if self.action is None:
+            log.warning("This command is not available.")
             return False
 
+        eligibility = self.eligibility
+        if args["user_level"] < eligibility.level:
+            # User does not have a high enough power level to run this command
+            return False
+
+        if args["whisper"] and not eligibility.whisper:
+            # This user cannot execute the command through a whisper
+            return False
+
+        if (
+            channel
+            and eligibility.channels
+            and str(channel.id) not in eligibility.channels
+        ):
+            return False
+
+        cd_modifier = 0.2 if args["user_level"] >= 500 else 1.0
+
         cur_time = greenbot.utils.now().timestamp()
-        time_since_last_run = (cur_time - self.last_run) / cd_modifier
+        last_run, last_run_by_user = bot.cooldown_manager.get_last_runs(
+            self, author.id
+        )
+        time_since_last_run = (cur_time - last_run) / cd_modifier
 
         if (
             time_since_last_run < self.delay_all
@@ -407,9 +803,7 @@ class Command(Base):
             await bot.private_message(user=author, message=f"The command **{self.command}** was executed too recently please try again in {greenbot.utils.seconds_to_resp(int(self.delay_all-time_since_last_run))}", ignore_escape=True)
             return False
 
-        time_since_last_run_user = (
-            cur_time - self.last_run_by_user.get(str(author.id), 0)
-        ) / cd_modifier
+        time_since_last_run_user = (cur_time - last_run_by_user) / cd_modifier
 
         if (
             time_since_last_run_user < self.delay_user
@@ -417,49 +811,57 @@ class Command(Base):
         ):
             await bot.private_message(user=author, message=f"You executed the command **{self.command}** too recently please try again in {greenbot.utils.seconds_to_resp(int(self.delay_user-time_since_last_run_user))}", ignore_escape=True)
             return False
-        with DBManager.create_session_scope() as db_session:
-            user = User._create_or_get_by_discord_id(
-                db_session, str(author.id), str(author)
-            )
-            if self.cost > 0 and not user.can_afford(self.cost) and args["user_level"] < Command.BYPASS_DELAY_LEVEL:
-                # User does not have enough points to use the command
-                await bot.private_message(user=author, message=f"You need {self.cost} points to execute that command", ignore_escape=True)
-                return False
+        user = await bot.user_manager.fetch(author.id, str(author))
+        if self.cost > 0 and not user.can_afford(self.cost) and args["user_level"] < Command.BYPASS_DELAY_LEVEL:
+            # User does not have enough points to use the command
+            await bot.private_message(user=author, message=f"You need {self.cost} points to execute that command", ignore_escape=True)
+            return False
 
-            args.update(self.extra_args)
-            if self.run_in_thread:
-                log.debug(f"Running {self} in a thread")
-                await ScheduleManager.execute_now(
-                    self.run_action, args=[bot, author, channel, message, args]
-                )
-            else:
-                await self.run_action(bot, author, channel, message, args)
+        args.update(self.extra_args)
+        if self.run_in_thread:
+            log.debug(f"Running {self} in a thread")
+            await ScheduleManager.execute_now(
+                self.run_action, args=[bot, author, channel, message, args]
+            )
+        else:
+            await self.run_action(bot, author, channel, message, args)
 
         return True
 
     async def run_action(self, bot, author, channel, message, args):
         cur_time = greenbot.utils.now().timestamp()
-        with DBManager.create_session_scope() as db_session:
-            user = User._create_or_get_by_discord_id(
-                db_session, str(author.id), str(author)
-            )
-            with user.spend_currency_context(self.cost if args["user_level"] < Command.BYPASS_DELAY_LEVEL else 0):
-                ret = await self.action.run(bot, author, channel, message, args)
-                if not ret:
-                    raise FailedCommand("return currency")
+        cost = self.cost if args["user_level"] < Command.BYPASS_DELAY_LEVEL else 0
+        if cost <= 0:
+            # Nothing to spend, so there's no need to touch the user
+            if await self.action.run(bot, author, channel, message, args):
+                self.mark_used(bot, author, cur_time)
+            return
+
+        # The spend is a single conditional UPDATE, so two commands racing for
+        # the same points can't both succeed
+        reason = f"command:{self.command}"
+        if await bot.points_manager.spend(author.id, cost, reason) is None:
+            await bot.private_message(user=author, message=f"You need {cost} points to execute that command", ignore_escape=True)
+            return
+
+        try:
+            ret = await self.action.run(bot, author, channel, message, args)
+        except:
+            await bot.points_manager.refund(author.id, cost, f"{reason}:refund")
+            raise
+
+        if not ret or ret == "return currency":
+            await bot.points_manager.refund(author.id, cost, f"{reason}:refund")
 
-                # Only spend points, and increment num_uses if the action succeded
-                if self.data is not None:
-                    self.data.num_uses += 1
-                    self.data.last_date_used = greenbot.utils.now()
+        # Only increment num_uses if the action succeded
+        if ret:
+            self.mark_used(bot, author, cur_time)
 
-                # TODO: Will this be an issue?
-                self.last_run = cur_time
-                self.last_run_by_user[str(author.id)] = cur_time
+    def mark_used(self, bot, author, cur_time):
+        if self.data is not None:
+            bot.commands.record_use(self)
 
-                if ret == "return currency":
-                    db_session.commit()
-                    raise FailedCommand("return currency")
+        bot.cooldown_manager.mark(self, author.id, cur_time)
 
     def jsonify(self):
         """ jsonify will only be called from the web interface.
@@ -60,6 +60,27 @@ class Giveaway(Base):
     def _get_current_giveaway(db_session):
         return db_session.query(Giveaway).filter_by(enabled=True).one_or_none()
 
+    @staticmethod
+    def _join(db_session, user_id, tickets):
+        """ Enters the user into the current giveaway.
+        Returns the outcome and the item and deadline of the giveaway """
+        current_giveaway = Giveaway._get_current_giveaway(db_session)
+        if not current_giveaway:
+            return "not_running", None, None
+
+        giveaway_item = current_giveaway.giveaway_item
+        giveaway_deadline = current_giveaway.giveaway_deadline
+        if current_giveaway.locked:
+            return "locked", giveaway_item, giveaway_deadline
+
+        if GiveawayEntry.is_entered(db_session, user_id, current_giveaway.id):
+            return "entered", giveaway_item, giveaway_deadline
+
+        if not GiveawayEntry._create(db_session, user_id, current_giveaway.id, tickets):
+            return "failed", giveaway_item, giveaway_deadline
+
+        return "joined", giveaway_item, giveaway_deadline
+
     
 class GiveawayEntry(Base):
     __tablename__ = "giveaway_entries"
@@ -3,10 +3,12 @@ import json
 
 from contextlib import contextmanager
 
-from sqlalchemy import TEXT, BOOLEAN
+from sqlalchemy import INT, TEXT, BOOLEAN
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, IntegrityError
 from sqlalchemy.orm import relationship
 from sqlalchemy_utc import UtcDateTime
 
@@ -14,7 +16,7 @@ from greenbot.exc import FailedCommand
 from greenbot.managers.db import Base
 import greenbot.utils as utils
 
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 
 log = logging.getLogger(__name__)
@@ -27,32 +29,158 @@ class Message(Base):
     user_id = Column(TEXT, ForeignKey("user.discord_id", ondelete="CASCADE"))
     channel_id = Column(TEXT, nullable=True)
     content = Column(TEXT, nullable=False)
-    time_sent = Column(UtcDateTime(), nullable=True, server_default="NULL")
+    # The table is partitioned by day on time_sent, see _create_partitions
+    time_sent = Column(UtcDateTime(), primary_key=True, nullable=False)
     credited = Column(BOOLEAN, nullable=False, default=False)
     user = relationship("User")
 
-    def edit_message(self, db_session, data):
-        local_content = json.loads(self.content)
-        local_content.append(data)
-        self.content = json.dumps(local_content)
-        db_session.merge(self)
-        return self
+    @staticmethod
+    def _edit(db_session, message_id, data):
+        """ Adds data as a new revision of the message, returns the user and channel id of the message """
+        message = (
+            db_session.query(Message.user_id, Message.channel_id)
+            .filter_by(message_id=str(message_id))
+            .one_or_none()
+        )
+        if not message:
+            return None
+
+        db_session.add(
+            MessageRevision(
+                message_id=str(message_id), content=data, time_edited=utils.now()
+            )
+        )
+        return message.user_id, message.channel_id
 
     @staticmethod
-    def _create(
-        db_session, message_id, user_id, channel_id, content
-    ):  # Content is an array
-        if Message._get(db_session, message_id):
+    def _get_history(db_session, message_id, limit=None):
+        """ Returns the last limit versions of the content (oldest first), user id and channel id of the message """
+        message = Message._get(db_session, message_id)
+        if not message:
             return None
-        user = Message(
-            message_id=str(message_id),
-            user_id=str(user_id),
-            channel_id=str(channel_id),
-            content=json.dumps(content),
-            time_sent=utils.now(),
+
+        query = (
+            db_session.query(MessageRevision.content)
+            .filter_by(message_id=message.message_id)
+            .order_by(MessageRevision.id.desc())
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        content = [revision.content for revision in reversed(query.all())]
+        if limit is None or len(content) < limit:
+            content = json.loads(message.content) + content
+            if limit is not None:
+                content = content[-limit:]
+
+        return content, message.user_id, message.channel_id
+
+    @staticmethod
+    def _create_many(db_session, messages):
+        """ Inserts all the given message rows with a single statement.
+        Messages that already exist are skipped """
+        if not messages:
+            return
+
+        # The primary key includes time_sent because of the partitioning,
+        # so a redelivered message has to be filtered out by its id
+        existing = {
+            message_id
+            for (message_id,) in db_session.query(Message.message_id).filter(
+                Message.message_id.in_([message["message_id"] for message in messages])
+            )
+        }
+        messages = [message for message in messages if message["message_id"] not in existing]
+        if not messages:
+            return
+
+        db_session.execute(
+            insert(Message.__table__)
+            .values(messages)
+            .on_conflict_do_nothing(index_elements=["message_id", "time_sent"])
+        )
+
+    @staticmethod
+    def _create_each(db_session, messages):
+        """ Inserts the given message rows one at a time, each in its own savepoint.
+        Returns the ids of the messages that could not be written """
+        failed = []
+        for message in messages:
+            try:
+                with db_session.begin_nested():
+                    Message._create_many(db_session, [message])
+            except (DataError, IntegrityError):
+                log.exception(f"Failed to write message {message['message_id']}")
+                failed.append(message["message_id"])
+        return failed
+
+    @staticmethod
+    def _partition_name(day):
+        return f"message_p{day:%Y%m%d}"
+
+    @staticmethod
+    def _create_partitions(db_session, first_day, days):
+        """ Makes sure there is a partition for each of the days starting at first_day """
+        for offset in range(days):
+            day = first_day + timedelta(days=offset)
+            db_session.execute(
+                f"CREATE TABLE IF NOT EXISTS {Message._partition_name(day)} PARTITION OF message "
+                f"FOR VALUES FROM ('{day.isoformat()} 00:00:00+00') TO ('{(day + timedelta(days=1)).isoformat()} 00:00:00+00')"
+            )
+
+    @staticmethod
+    def _expire_partitions(db_session, before_day, archive=False):
+        """ Detaches the partitions of the days before before_day.
+        Archived partitions are kept as message_archive_<day> tables, otherwise they are dropped
+        together with the revisions of that time.
+        Expired rows of message_history, which holds everything from before the partitioning,
+        are moved to message_archive_history or deleted """
+        before = f"{before_day.isoformat()} 00:00:00+00"
+        if archive:
+            db_session.execute(
+                "CREATE TABLE IF NOT EXISTS message_archive_history (LIKE message)"
+            )
+            db_session.execute(
+                "INSERT INTO message_archive_history SELECT * FROM message_history "
+                "WHERE time_sent < :before",
+                {"before": before},
+            )
+        db_session.execute(
+            "DELETE FROM message_history WHERE time_sent < :before", {"before": before}
         )
-        db_session.add(user)
-        return user
+
+        partitions = db_session.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+            "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+            "WHERE parent.relname = 'message'"
+        ).fetchall()
+
+        expired = []
+        for (partition_name,) in partitions:
+            try:
+                day = datetime.strptime(partition_name, "message_p%Y%m%d").date()
+            except ValueError:
+                # The default and history partitions
+                continue
+
+            if day >= before_day:
+                continue
+
+            db_session.execute(f"ALTER TABLE message DETACH PARTITION {partition_name}")
+            if archive:
+                db_session.execute(
+                    f"ALTER TABLE {partition_name} RENAME TO message_archive_{day:%Y%m%d}"
+                )
+            else:
+                db_session.execute(f"DROP TABLE {partition_name}")
+            expired.append(partition_name)
+
+        if not archive:
+            db_session.query(MessageRevision).filter(
+                MessageRevision.time_edited < before
+            ).delete(synchronize_session=False)
+
+        return expired
 
     @staticmethod
     def _get_messages(db_session, user_id):
@@ -125,3 +253,12 @@ class Message(Base):
             .filter_by(message_id=str(message_id))
             .one_or_none()
         )
+
+
+class MessageRevision(Base):
+    __tablename__ = "message_revision"
+
+    id = Column(INT, primary_key=True, autoincrement=True)
+    message_id = Column(TEXT, nullable=False, index=True)
+    content = Column(TEXT, nullable=False)
+    time_edited = Column(UtcDateTime(), nullable=False)
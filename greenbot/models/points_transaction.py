@@ -0,0 +1,31 @@
+import logging
+
+from sqlalchemy import BIGINT, INT, TEXT
+from sqlalchemy import Column
+from sqlalchemy_utc import UtcDateTime
+
+from greenbot.managers.db import Base
+
+log = logging.getLogger(__name__)
+
+
+class PointsTransaction(Base):
+    """ Append-only audit log of every change to a users points """
+
+    __tablename__ = "points_transaction"
+
+    id = Column(BIGINT, primary_key=True, autoincrement=True)
+    user_id = Column(TEXT, nullable=False, index=True)
+    amount = Column(INT, nullable=False)
+    # The balance right after the change, if it is known
+    balance = Column(INT, nullable=True)
+    reason = Column(TEXT, nullable=False)
+    created_at = Column(UtcDateTime(), nullable=False)
+
+    @staticmethod
+    def _create_many(db_session, transactions):
+        """ Inserts all the given transaction rows with a single statement """
+        if not transactions:
+            return
+
+        db_session.execute(PointsTransaction.__table__.insert().values(transactions))
@@ -4,6 +4,7 @@ from contextlib import contextmanager
 
 from sqlalchemy import INT, TEXT
 from sqlalchemy import Column
+from sqlalchemy import text
 
 from greenbot.exc import FailedCommand
 from greenbot.managers.db import Base
@@ -49,6 +50,53 @@ class User(Base):
             user.user_name = user_name
         return user
 
+    @staticmethod
+    def _get_attribute(db_session, discord_id, key):
+        user = db_session.query(User).filter_by(discord_id=str(discord_id)).one_or_none()
+        return getattr(user, key) if user else None
+
+    @staticmethod
+    def _update(db_session, discord_id, **fields):
+        return (
+            db_session.query(User)
+            .filter_by(discord_id=str(discord_id))
+            .update(fields, synchronize_session=False)
+        )
+
+    @staticmethod
+    def _spend_points(db_session, discord_id, cost):
+        """ Takes cost points from the user if they can afford it, returns the new balance or None """
+        return db_session.execute(
+            text(
+                'UPDATE "user" SET points = points - :cost '
+                "WHERE discord_id = :discord_id AND points >= :cost RETURNING points"
+            ),
+            {"cost": cost, "discord_id": str(discord_id)},
+        ).scalar()
+
+    @staticmethod
+    def _add_points(db_session, discord_id, amount):
+        """ Adds amount (which may be negative) to the users points, returns the new balance or None """
+        return db_session.execute(
+            text(
+                'UPDATE "user" SET points = points + :amount '
+                "WHERE discord_id = :discord_id RETURNING points"
+            ),
+            {"amount": amount, "discord_id": str(discord_id)},
+        ).scalar()
+
+    @staticmethod
+    def _set_points(db_session, discord_id, points):
+        """ Sets the users points, returns the previous balance or None """
+        return db_session.execute(
+            text(
+                'UPDATE "user" SET points = :points FROM '
+                '(SELECT points FROM "user" WHERE discord_id = :discord_id FOR UPDATE) AS previous '
+                'WHERE "user".discord_id = :discord_id RETURNING previous.points'
+            ),
+            {"points": points, "discord_id": str(discord_id)},
+        ).scalar()
+
     @staticmethod
     def _get_users_with_points(db_session, points):
         return db_session.query(User).filter(User.points >= points).all()
@@ -104,16 +104,34 @@ class ActivityTracker(BaseModule):
             )
             messages = Message._get_last_hour(db_session, channels_to_listen_in)
             counts_by_day = Message._get_day_count_by_user(db_session)
+            credits = {}
             for message in messages:
                 count = counts_by_day.get(message.user_id, 0)
                 if message.user_id != str(self.bot.bot_id):
+                    credit = 0
                     if count < self.settings["daily_max_msgs"] - 1:
-                        message.user.points += self.settings["hourly_credit"]
+                        credit = self.settings["hourly_credit"]
                     elif count == self.settings["daily_max_msgs"] - 1:
-                        message.user.points += self.settings["daily_limit"]
+                        credit = self.settings["daily_limit"]
+                    if credit:
+                        credits[message.user_id] = credits.get(message.user_id, 0) + credit
                 message.credited = True
                 counts_by_day[message.user_id] = count + 1
 
+            # Atomic increments, so spends and refunds running at the same time aren't overwritten.
+            # They are committed together with the credited flags
+            balances = {
+                user_id: User._add_points(db_session, user_id, credit)
+                for user_id, credit in credits.items()
+            }
+            db_session.commit()
+            for user_id, balance in balances.items():
+                self.bot.points_manager.update_cache(user_id, balance)
+                if balance is not None:
+                    self.bot.points_manager.record(
+                        user_id, credits[user_id], "activity", balance
+                    )
+
             for user in User._get_users_with_points(
                 db_session, self.settings["min_regular_points"]
             ):
@@ -1,5 +1,4 @@
 import logging
-import json
 import discord
 import datetime
 
@@ -168,12 +167,10 @@ class AdvancedAdminLog(BaseModule):
                 [int(self.settings["output_channel"])], None, {}
             )[0]
         message_id = payload.message_id
-        with DBManager.create_session_scope() as db_session:
-            db_message = Message._get(db_session, message_id)
-            if not db_message:
-                return
-            content = json.loads(db_message.content)
-            author_id = db_message.user_id
+        db_message = await DBManager.run(Message._get_history, message_id, 1)
+        if not db_message:
+            return
+        content, author_id, _ = db_message
         sent_in_channel = self.bot.filters.get_channel([int(payload.channel_id)], None, {})[0]
         channels = (
             self.settings["ingore_channels"].split(" ")
@@ -233,12 +230,10 @@ class AdvancedAdminLog(BaseModule):
         if not guild_id or self.bot.discord_bot.guild.id != int(guild_id):
             return
 
-        with DBManager.create_session_scope() as db_session:
-            db_message = Message._get(db_session, str(message_id))
-            if not db_message:
-                return
-            content = json.loads(db_message.content)
-            author_id = db_message.user_id
+        db_message = await DBManager.run(Message._get_history, str(message_id), 2)
+        if not db_message:
+            return
+        content, author_id, _ = db_message
         author = self.bot.discord_bot.get_member(int(author_id))
         if int(author_id) == self.bot.discord_bot.client.user.id:
             return
@@ -1121,17 +1116,12 @@ class AdvancedAdminLog(BaseModule):
             await self.bot.say(channel=channel, embed=embed)
             return
         message_id = _args[0]
-        with DBManager.create_session_scope() as db_session:
-            db_message = Message._get(db_session, str(message_id))
-            if db_message:
-                content = json.loads(db_message.content)
-                author_id = db_message.user_id
-                channel_id = db_message.channel_id
-
+        db_message = await DBManager.run(Message._get_history, str(message_id), 2)
         if not db_message:
             embed.description = f"Message not found with message id {message_id}"
             await self.bot.say(channel=channel, embed=embed)
             return
+        content, author_id, channel_id = db_message
         sent_in_channel = self.bot.filters.get_channel([int(channel_id)], None, {})[0]
 
         try:
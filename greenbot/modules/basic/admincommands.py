@@ -91,7 +91,7 @@ class AdminCommandsModule(BaseModule):
                 return
 
             # Rebuild command cache
-            bot.commands.rebuild()
+            bot.commands.update_module(module_id)
 
             with DBManager.create_session_scope() as db_session:
                 db_module = db_session.query(Module).filter_by(id=module_id).one()
@@ -142,7 +142,7 @@ class AdminCommandsModule(BaseModule):
                 return
 
             # Rebuild command cache
-            bot.commands.rebuild()
+            bot.commands.update_module(module_id)
 
             with DBManager.create_session_scope() as db_session:
                 db_module = db_session.query(Module).filter_by(id=module_id).one()
@@ -13,7 +13,7 @@ from greenbot.managers.schedule import ScheduleManager
 from greenbot.managers.db import DBManager
 from greenbot.managers.redis import RedisManager
 from greenbot.models.command import Command
-from greenbot.models.giveaway import Giveaway, GiveawayEntry
+from greenbot.models.giveaway import Giveaway
 from greenbot.modules import BaseModule
 from greenbot.modules import ModuleSetting
 
@@ -141,29 +141,28 @@ class GiveawayModule(BaseModule):
         await self.bot.say(channel=channel, embed=embed)
 
     async def giveaway_join(self, bot, author, channel, message, args):
-        with DBManager.create_session_scope() as db_session:
-            current_giveaway = Giveaway._get_current_giveaway(db_session)
-            if not current_giveaway:
-                await self.bot.say(channel=channel, message=f"{author.mention}, there is no giveaway running right now.", ignore_escape=True)
-                return False
+        tickets = self.get_highest_ticket_count(author)
+        status, giveaway_item, giveaway_deadline = await DBManager.run(
+            Giveaway._join, str(author.id), tickets
+        )
+        if status == "not_running":
+            await self.bot.say(channel=channel, message=f"{author.mention}, there is no giveaway running right now.", ignore_escape=True)
+            return False
 
-            if current_giveaway.locked:
-                await self.bot.say(channel=channel, message=f"{author.mention}, the current giveaway is locked.", ignore_escape=True)
-                return False
+        if status == "locked":
+            await self.bot.say(channel=channel, message=f"{author.mention}, the current giveaway is locked.", ignore_escape=True)
+            return False
 
-            registered = GiveawayEntry.is_entered(db_session, str(author.id), current_giveaway.id)
-            if registered:
-                await self.bot.say(channel=channel, message=f"{author.mention}, you already joined the giveaway.", ignore_escape=True)
-                return False
+        if status == "entered":
+            await self.bot.say(channel=channel, message=f"{author.mention}, you already joined the giveaway.", ignore_escape=True)
+            return False
 
-            tickets = self.get_highest_ticket_count(author)
-            giveaway_entry = GiveawayEntry._create(db_session, str(author.id), current_giveaway.id, tickets)
-            if giveaway_entry:
-                await self.bot.say(channel=channel, message=f"{author.mention}, you joined the giveaway for **{current_giveaway.giveaway_item}** with **{tickets}** entr{'y' if tickets == 1 else 'ies' }! The giveaway will end **{current_giveaway.giveaway_deadline}** and you will be notified if you win. Good Luck! :wink:", ignore_escape=True)
-                return True
+        if status == "joined":
+            await self.bot.say(channel=channel, message=f"{author.mention}, you joined the giveaway for **{giveaway_item}** with **{tickets}** entr{'y' if tickets == 1 else 'ies' }! The giveaway will end **{giveaway_deadline}** and you will be notified if you win. Good Luck! :wink:", ignore_escape=True)
+            return True
 
-            await self.bot.say(channel=channel, message=f"{author.mention} failed to add you to the giveaway dm a mod for help :smile:", ignore_escape=True)
-            return False
+        await self.bot.say(channel=channel, message=f"{author.mention} failed to add you to the giveaway dm a mod for help :smile:", ignore_escape=True)
+        return False
 
     def get_highest_ticket_count(self, member):
         role_dict = {
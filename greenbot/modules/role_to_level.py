@@ -65,6 +65,7 @@ class RoleToLevel(BaseModule):
             return
         self.bot.roles[str(role.id)] = level
         self.redis.set(f"{self.bot.bot_name}:role-level", json.dumps(self.bot.roles))
+        self.bot.refresh_role_levels()
         await self.bot.say(
             channel, f"Level, {command_args[1]} assigned to role, {role.mention}"
         )
@@ -76,6 +77,7 @@ class RoleToLevel(BaseModule):
             self.redis.set(
                 f"{self.bot.bot_name}:role-level", json.dumps(self.bot.roles)
             )
+            self.bot.refresh_role_levels()
             await self.bot.say(channel, f"Removed role with id {command_args[0]}")
             return
         role = self.bot.filters.get_role([command_args[0]], None, {})[0]
@@ -98,6 +100,7 @@ class RoleToLevel(BaseModule):
         del self.bot.roles[str(role.id)]
 
         self.redis.set(f"{self.bot.bot_name}:role-level", json.dumps(self.bot.roles))
+        self.bot.refresh_role_levels()
         await self.bot.say(channel, f"{role.mention} no longer has a level")
 
     def load_commands(self, **options):
@@ -130,8 +133,10 @@ class RoleToLevel(BaseModule):
         except:
             self.redis.set(f"{self.bot.bot_name}:role-level", json.dumps({}))
             self.bot.roles = {}
+        self.bot.refresh_role_levels()
 
     def disable(self, bot):
         if not bot:
             return
         self.bot.roles = {}
+        self.bot.refresh_role_levels()
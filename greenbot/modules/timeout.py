@@ -86,7 +86,7 @@ class TimeoutModule(BaseModule):
             return False
 
         with DBManager.create_session_scope() as db_session:
-            user_level = self.bot.psudo_level_member(db_session, member)
+            user_level = await self.bot.psudo_level_member(db_session, member)
 
             if user_level >= args["user_level"]:
                 await self.bot.say(
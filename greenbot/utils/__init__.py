@@ -1,5 +1,7 @@
 from .dump_threads import dump_threads
 from .find import find
+from .normalized_content import NormalizedContent
+from .aho_corasick import AhoCorasick
 from .init_logging import init_logging
 from .load_config import load_config
 from .now import now
@@ -0,0 +1,57 @@
+from collections import deque
+
+
+class AhoCorasick:
+    """
+    Finds every occurrence of a set of patterns in a single pass over the text.
+    patterns is an iterable of (pattern, value) tuples, the value is returned with each match
+    """
+
+    def __init__(self, patterns):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+        for pattern, value in patterns:
+            if not pattern:
+                continue
+
+            node = 0
+            for char in pattern:
+                next_node = self.transitions[node].get(char, None)
+                if next_node is None:
+                    next_node = len(self.transitions)
+                    self.transitions[node][char] = next_node
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                node = next_node
+            self.outputs[node].append((len(pattern), value))
+
+        queue = deque(self.transitions[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.transitions[node].items():
+                queue.append(next_node)
+                fail = self.fail[node]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.transitions[fail].get(char, 0)
+                self.outputs[next_node] += self.outputs[self.fail[next_node]]
+
+    def __bool__(self):
+        return len(self.transitions) > 1
+
+    def search(self, text):
+        """ Yields (start, end, value) for every match, end is exclusive """
+        transitions = self.transitions
+        fail = self.fail
+        outputs = self.outputs
+
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in transitions[node]:
+                node = fail[node]
+            node = transitions[node].get(char, 0)
+            for length, value in outputs[node]:
+                yield index + 1 - length, index + 1, value
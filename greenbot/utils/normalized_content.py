@@ -0,0 +1,29 @@
+from unidecode import unidecode
+
+
+class NormalizedContent:
+    """
+    The content of a single message, with the views the content filters need.
+    Each view is computed the first time it is asked for and then reused
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.views = {}
+
+    def __str__(self):
+        return self.raw
+
+    def get(self, case_sensitive=True, remove_accents=False):
+        """ Returns the content the way Banphrase.format_message would format it """
+        key = (case_sensitive, remove_accents)
+        view = self.views.get(key, None)
+        if view is None:
+            if remove_accents:
+                view = unidecode(self.get(case_sensitive=case_sensitive)).strip()
+            elif not case_sensitive:
+                view = self.raw.lower()
+            else:
+                view = self.raw
+            self.views[key] = view
+        return view
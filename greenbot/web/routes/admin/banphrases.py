@@ -96,6 +96,20 @@ def init(page):
                 "operator": operator,
             }
 
+            if operator == "regex":
+                lint_error = Banphrase.lint_regex(phrase, case_sensitive)
+                if lint_error is not None:
+                    banphrase = Banphrase(**options)
+                    banphrase.id = id
+                    return (
+                        render_template(
+                            "admin/create_banphrase.html",
+                            banphrase=banphrase,
+                            lint_error=lint_error,
+                        ),
+                        400,
+                    )
+
             if id is None:
                 banphrase = Banphrase(**options)
                 banphrase.data = BanphraseData(
@@ -3,7 +3,9 @@ from flask_restful import Api
 import greenbot.web.routes.api.banphrases
 import greenbot.web.routes.api.commands
 import greenbot.web.routes.api.common
+import greenbot.web.routes.api.latency
 import greenbot.web.routes.api.modules
+import greenbot.web.routes.api.render_budget
 import greenbot.web.routes.api.timers
 import greenbot.web.routes.api.users
 
@@ -30,3 +32,9 @@ def init(app):
 
     # /modules
     greenbot.web.routes.api.modules.init(api)
+
+    # /latency
+    greenbot.web.routes.api.latency.init(api)
+
+    # /render-budget
+    greenbot.web.routes.api.render_budget.init(api)
@@ -1,20 +1,172 @@
+import json
 import logging
+import threading
+import uuid
 
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from datetime import timedelta
 from flask_restful import Resource
 from flask_restful import reqparse
+from sqlalchemy import select
 
 import greenbot.modules
 import greenbot.utils
 import greenbot.web.utils
+from greenbot.bothelper import BotHelper
 from greenbot.managers.adminlog import AdminLogManager
 from greenbot.managers.db import DBManager
+from greenbot.managers.redis import RedisManager
 from greenbot.models.banphrase import Banphrase
 from greenbot.models.banphrase import BanphraseManager
+from greenbot.models.banphrase import BanphraseMatcher
+from greenbot.models.message import Message
 from greenbot.managers.sock import SocketClientManager
+from greenbot.utils import NormalizedContent
 
 log = logging.getLogger(__name__)
 
 
+def backtest_chunk(banphrase_options, contents, max_samples):
+    """
+    Runs in the backtest process pool.
+    Returns how many of the stored message contents the banphrase hits, some of the hits
+    and whether the banphrase ran over its time budget
+    """
+    matcher = BanphraseMatcher([Banphrase(**banphrase_options)])
+    hits = 0
+    samples = []
+    timed_out = []
+    for content in contents:
+        message = json.loads(content)[-1]
+        if matcher.match(NormalizedContent(message), timed_out):
+            hits += 1
+            if len(samples) < max_samples:
+                samples.append(message)
+        if timed_out:
+            return hits, samples, True
+
+    return hits, samples, False
+
+
+class BanphraseBacktest:
+    """
+    Runs a banphrase against the stored messages in a background thread, the matching is done in a process pool.
+    The progress is kept in redis so any web worker can report it
+    """
+
+    # Messages are read from the database and handed to the pool in chunks of this size
+    CHUNK_SIZE = 5000
+    POOL_SIZE = 4
+    MAX_DAYS = 30
+    MAX_SAMPLES = 10
+    # How long (in seconds) the results are kept around
+    RESULT_EXPIRY = 60 * 60
+
+    executor = None
+
+    @staticmethod
+    def redis_key(job_id):
+        return f"{BotHelper.get_bot_name()}:banphrase-backtest:{job_id}"
+
+    @staticmethod
+    def save(job_id, result):
+        RedisManager.get().setex(
+            BanphraseBacktest.redis_key(job_id),
+            BanphraseBacktest.RESULT_EXPIRY,
+            json.dumps(result),
+        )
+
+    @staticmethod
+    def get(job_id):
+        result = RedisManager.get().get(BanphraseBacktest.redis_key(job_id))
+        return json.loads(result) if result is not None else None
+
+    @staticmethod
+    def start(banphrase_options, days):
+        if BanphraseBacktest.executor is None:
+            BanphraseBacktest.executor = ProcessPoolExecutor(
+                max_workers=BanphraseBacktest.POOL_SIZE
+            )
+
+        job_id = uuid.uuid4().hex
+        BanphraseBacktest.save(
+            job_id,
+            {"status": "running", "days": days, "checked": 0, "hits": 0, "samples": []},
+        )
+        threading.Thread(
+            target=BanphraseBacktest.run,
+            args=(job_id, banphrase_options, days),
+            daemon=True,
+        ).start()
+        return job_id
+
+    @staticmethod
+    def run(job_id, banphrase_options, days):
+        result = {
+            "status": "running",
+            "days": days,
+            "checked": 0,
+            "hits": 0,
+            "samples": [],
+        }
+        pending = set()
+
+        def collect(futures):
+            for future in futures:
+                hits, samples, timed_out = future.result()
+                result["hits"] += hits
+                result["samples"] += samples[
+                    : BanphraseBacktest.MAX_SAMPLES - len(result["samples"])
+                ]
+                if timed_out:
+                    result["status"] = "too_slow"
+
+        try:
+            with DBManager.create_session_scope() as db_session:
+                # Server side cursor, so only the chunks in flight are held in memory
+                rows = db_session.connection(
+                    execution_options={"stream_results": True}
+                ).execute(
+                    select([Message.content]).where(
+                        Message.time_sent > greenbot.utils.now() - timedelta(days=days)
+                    )
+                )
+                while result["status"] == "running":
+                    contents = [
+                        row.content
+                        for row in rows.fetchmany(BanphraseBacktest.CHUNK_SIZE)
+                    ]
+                    if not contents:
+                        break
+
+                    pending.add(
+                        BanphraseBacktest.executor.submit(
+                            backtest_chunk,
+                            banphrase_options,
+                            contents,
+                            BanphraseBacktest.MAX_SAMPLES,
+                        )
+                    )
+                    result["checked"] += len(contents)
+                    if len(pending) >= BanphraseBacktest.POOL_SIZE * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                        BanphraseBacktest.save(job_id, result)
+                rows.close()
+
+            done, pending = wait(pending)
+            collect(done)
+            if result["status"] == "running":
+                result["status"] = "done"
+        except:
+            log.exception(f"Backtest {job_id} failed")
+            result["status"] = "failed"
+
+        BanphraseBacktest.save(job_id, result)
+
+
 class APIBanphraseRemove(Resource):
     @greenbot.web.utils.requires_level(500)
     def get(self, banphrase_id, **options):
@@ -94,7 +246,7 @@ class APIBanphraseTest(Resource):
 
         banphrase_manager = BanphraseManager(None).load()
         try:
-            res = banphrase_manager.check_message(message, None)
+            res = banphrase_manager.check_message(message)
         finally:
             banphrase_manager.db_session.close()
 
@@ -105,6 +257,84 @@ class APIBanphraseTest(Resource):
         return ret
 
 
+class APIBanphraseBacktest(Resource):
+    def __init__(self):
+        super().__init__()
+
+        self.post_parser = reqparse.RequestParser()
+        self.post_parser.add_argument("banphrase_id", required=False)
+        self.post_parser.add_argument("phrase", required=False)
+        self.post_parser.add_argument("operator", required=False, default="contains")
+        self.post_parser.add_argument("case_sensitive", required=False, default="0")
+        self.post_parser.add_argument("remove_accents", required=False, default="0")
+        self.post_parser.add_argument("days", required=False, default="7")
+
+    @greenbot.web.utils.requires_level(500)
+    def post(self, **options):
+        args = self.post_parser.parse_args()
+
+        try:
+            days = int(args["days"])
+        except ValueError:
+            return {"error": "Invalid `days` parameter."}, 400
+
+        if days < 1 or days > BanphraseBacktest.MAX_DAYS:
+            return {"error": f"`days` must be between 1 and {BanphraseBacktest.MAX_DAYS}."}, 400
+
+        if args["banphrase_id"]:
+            try:
+                banphrase_id = int(args["banphrase_id"])
+            except ValueError:
+                return {"error": "Invalid `banphrase_id` parameter."}, 400
+
+            with DBManager.create_session_scope() as db_session:
+                banphrase = (
+                    db_session.query(Banphrase).filter_by(id=banphrase_id).one_or_none()
+                )
+                if banphrase is None:
+                    return {"error": "Banphrase with this ID not found"}, 404
+
+                banphrase_options = {
+                    "phrase": banphrase.phrase,
+                    "operator": banphrase.operator,
+                    "case_sensitive": banphrase.case_sensitive,
+                    "remove_accents": banphrase.remove_accents,
+                }
+        else:
+            if not args["phrase"]:
+                return {"error": "Either `banphrase_id` or `phrase` is required."}, 400
+
+            banphrase_options = {
+                "phrase": args["phrase"],
+                "operator": args["operator"].strip().lower(),
+                "case_sensitive": args["case_sensitive"] in ("1", "on", "true"),
+                "remove_accents": args["remove_accents"] in ("1", "on", "true"),
+            }
+
+        if banphrase_options["operator"] not in BanphraseMatcher.PLAIN_OPERATORS + ("regex",):
+            return {"error": "Invalid `operator` parameter."}, 400
+
+        if banphrase_options["operator"] == "regex":
+            lint_error = Banphrase.lint_regex(
+                banphrase_options["phrase"], banphrase_options["case_sensitive"]
+            )
+            if lint_error is not None:
+                return {"error": lint_error}, 400
+
+        job_id = BanphraseBacktest.start(banphrase_options, days)
+        return {"job_id": job_id}, 202
+
+
+class APIBanphraseBacktestResult(Resource):
+    @greenbot.web.utils.requires_level(500)
+    def get(self, job_id, **options):
+        result = BanphraseBacktest.get(job_id)
+        if result is None:
+            return {"error": "Backtest with this ID not found"}, 404
+
+        return result
+
+
 class APIBanphraseDump(Resource):
     def __init__(self):
         super().__init__()
@@ -125,5 +355,11 @@ def init(api):
     # Test a message against banphrases
     api.add_resource(APIBanphraseTest, "/banphrases/test")
 
+    # Run a banphrase against the stored messages
+    api.add_resource(APIBanphraseBacktest, "/banphrases/backtest")
+    api.add_resource(
+        APIBanphraseBacktestResult, "/banphrases/backtest/<string:job_id>"
+    )
+
     # Dump
     # api.add_resource(APIBanphraseDump, '/banphrases/dump')
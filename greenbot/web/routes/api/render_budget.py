@@ -0,0 +1,24 @@
+import json
+
+from flask_restful import Resource
+
+import greenbot.web.utils
+from greenbot.bothelper import BotHelper
+from greenbot.managers.redis import RedisManager
+from greenbot.models.action import RenderBudget
+
+
+class APIRenderBudget(Resource):
+    @greenbot.web.utils.requires_level(500)
+    def get(self, **options):
+        summary = RedisManager.get().get(
+            RenderBudget.redis_key(BotHelper.get_bot_name())
+        )
+        if summary is None:
+            return {}
+
+        return json.loads(summary)
+
+
+def init(api):
+    api.add_resource(APIRenderBudget, "/render-budget")
@@ -11,6 +11,7 @@ import re
 
 from greenbot.managers.db import DBManager
 from greenbot.managers.redis import RedisManager
+from greenbot.managers.sock import SocketClientManager
 from greenbot.models.user import User
 
 import base64
@@ -39,6 +40,8 @@ def init(app):
             session["user"] = User._create_or_get_by_discord_id(
                 db_session, str(user.id), str(user)
             ).jsonify()
+        # The bot caches users, make it reload the name
+        SocketClientManager.send("user.update", {"discord_id": str(user.id)})
         session["user_displayname"] = str(user)
         next_url = session.get("state", "/")
         return redirect(next_url)